@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import time
+import tracemalloc
+import pandas as pd
+
+from dydx_data_processing import ProcessedTrades
+from csv_date_filter import filter_csv_files
+from generate_test_data import generate_exports
+
+
+# Columns of the benchmark results file
+RESULT_COLUMNS = ["Commit", "Date", "Rows", "Stage", "Seconds"]
+
+
+# Function to find the commit being benchmarked, so results can be compared across commits
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Function to time one stage and record it
+def timed(results, stage, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    results.append((stage, time.perf_counter() - start))
+    print(f"  {stage:<24}{results[-1][1]:>10.3f}s")
+    return value
+
+
+# Function to call a function without its printed output
+def quietly(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+# Function to time every stage of the pipeline and the date filter on one set of exports
+def benchmark_pipeline(data_dir, start_date="2023-01-01", end_date="2023-06-30"):
+
+    results = []
+    cwd = os.getcwd()
+
+    # Run inside the data folder, all outputs are written next to the exports
+    os.chdir(data_dir)
+    try:
+        processed_trades = ProcessedTrades()
+
+        timed(
+            results,
+            "Transfers",
+            processed_trades.process_file,
+            "Transfers",
+            processed_trades.process_transfers,
+            "Transfers",
+        )
+        timed(
+            results,
+            "Deposit_Swaps",
+            processed_trades.process_file,
+            "Transfers",
+            processed_trades.process_deposit_swaps,
+            "Deposit_Swaps",
+        )
+        timed(
+            results,
+            "Funding",
+            processed_trades.process_file,
+            "Funding",
+            processed_trades.process_funding,
+            "Funding",
+        )
+        timed(
+            results,
+            "Trades",
+            processed_trades.process_file,
+            "Trades",
+            processed_trades.process_trades,
+            "Trades",
+        )
+        timed(results, "Granular_Data", processed_trades.process_granular_data)
+        timed(results, "Buy_Side_Loans", processed_trades.process_buy_side_loans)
+        timed(results, "Sell_Side_Loans", processed_trades.process_sell_side_loans)
+        timed(results, "Merge_Loans", processed_trades.merge_loans, False)
+        for data_dict, directory in [
+            (processed_trades.trade_data, "Trade_Data"),
+            (processed_trades.buy_side_data, "Buy_Side_Data"),
+            (processed_trades.sell_side_data, "Sell_Side_Data"),
+        ]:
+            timed(
+                results, f"Save_{directory}", processed_trades.save_data, data_dict, directory
+            )
+
+        # Filter the Koinly outputs and the trade data, without the printed file list
+        for directory in ["Output", "Trade_Data"]:
+            timed(
+                results,
+                f"Filter_{directory}",
+                quietly,
+                filter_csv_files,
+                directory,
+                pd.Timestamp(start_date),
+                pd.Timestamp(end_date),
+            )
+
+    finally:
+        os.chdir(cwd)
+
+    results.append(("Total", sum(seconds for _, seconds in results)))
+    print(f"  {'Total':<24}{results[-1][1]:>10.3f}s")
+    return results
+
+
+# Function to measure the peak memory of the trades -> blocks -> loans path, standard and compact
+def benchmark_memory(data_dir):
+
+    input_dir = os.path.join(data_dir, "Original_Files")
+    input_mb = os.path.getsize(os.path.join(input_dir, "Trades.csv")) / 2**20
+    print(f"  {'Trades.csv':<24}{input_mb:>10.1f} MB")
+
+    peaks = {}
+    for compact in [False, True]:
+
+        # Keep everything in memory, only the processing is measured
+        processed_trades = ProcessedTrades(
+            input_dir=input_dir, write_csv=False, compact=compact
+        )
+        tracemalloc.start()
+        try:
+            processed_trades.process_file(
+                "Trades", processed_trades.process_trades, "Trades"
+            )
+            processed_trades.process_granular_data()
+            processed_trades.process_buy_side_loans()
+            processed_trades.process_sell_side_loans()
+            peaks[compact] = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+
+        stage = "Compact" if compact else "Standard"
+        print(
+            f"  {stage:<24}{peaks[compact]:>10.1f} MB"
+            f"{peaks[compact] / input_mb:>8.1f}x input"
+        )
+
+    print(f"  {'Reduction':<24}{1 - peaks[True] / peaks[False]:>10.1%}")
+    return peaks
+
+
+# Function to print the stages of a run next to the previous commit's run with as many rows
+def compare_results(results_file, rows, commit):
+
+    df = pd.read_csv(results_file, dtype={"Commit": str})
+    df = df[df["Rows"] == rows]
+
+    # The latest run of each commit, in the order they were run
+    runs = df.drop_duplicates(["Commit", "Date"])[["Commit", "Date"]]
+    latest = runs.drop_duplicates("Commit", keep="last")
+    previous = latest[latest["Commit"] != commit].tail(1)
+    if previous.empty:
+        return
+
+    current = df[(df["Commit"] == commit) & (df["Date"] == runs["Date"].iloc[-1])]
+    before = df[
+        (df["Commit"] == previous["Commit"].iloc[0])
+        & (df["Date"] == previous["Date"].iloc[0])
+    ]
+    comparison = pd.merge(
+        before[["Stage", "Seconds"]],
+        current[["Stage", "Seconds"]],
+        on="Stage",
+        how="right",
+        suffixes=(f" {previous['Commit'].iloc[0]}", f" {commit}"),
+    )
+    comparison["Change"] = (
+        comparison.iloc[:, 2] / comparison.iloc[:, 1] - 1
+    ).map("{:+.1%}".format)
+    print(f"\n{rows} rows compared with the previous commit:")
+    print(comparison.to_string(index=False, float_format="{:.3f}".format))
+
+
+# Function to benchmark the pipeline at several sizes and append the results to a file
+def run_benchmarks(
+    sizes=(10000, 1000000, 10000000),
+    data_root="Benchmarks",
+    results_file="benchmark_results.csv",
+    markets=20,
+    years=3,
+    memory=False,
+):
+
+    commit = current_commit()
+    date = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for rows in sizes:
+
+        # Generate the exports once per size, later runs reuse them
+        data_dir = os.path.join(data_root, str(rows))
+        input_dir = os.path.join(data_dir, "Original_Files")
+        if not os.path.exists(os.path.join(input_dir, "Trades.csv")):
+            print(f"Generating {rows} rows in {input_dir}")
+            generate_exports(input_dir, markets=markets, trades=rows, years=years)
+
+        print(f"Benchmarking {rows} rows")
+        results = benchmark_pipeline(data_dir)
+
+        # Append the results, writing the header for a new file
+        df = pd.DataFrame(
+            [(commit, date, rows, stage, round(seconds, 4)) for stage, seconds in results],
+            columns=RESULT_COLUMNS,
+        )
+        df.to_csv(
+            results_file,
+            mode="a",
+            header=not os.path.exists(results_file),
+            index=False,
+        )
+        compare_results(results_file, rows, commit)
+
+        # Optionally compare the peak memory of the standard and compact representations
+        if memory:
+            print(f"Peak memory of {rows} rows")
+            benchmark_memory(data_dir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Time every pipeline stage on generated exports of several sizes"
+    )
+    parser.add_argument(
+        "sizes", nargs="*", type=int, default=[10000, 1000000, 10000000],
+        help="numbers of trades to benchmark",
+    )
+    parser.add_argument("--data-root", default="Benchmarks")
+    parser.add_argument("--results", default="benchmark_results.csv")
+    parser.add_argument("--markets", type=int, default=20)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument(
+        "--memory", action="store_true",
+        help="also compare the peak memory of the standard and compact modes",
+    )
+    args = parser.parse_args()
+
+    run_benchmarks(
+        args.sizes, args.data_root, args.results, args.markets, args.years, args.memory
+    )
@@ -1,99 +1,284 @@
+import io
 import os
+import sys
+import json
+import numpy as np
 import pandas as pd
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-def filter_csv_files(folder_path, start_date, end_date):
-    # Create a directory to save filtered files
-    folder_name = os.path.basename(folder_path)  # Extract the folder name from the folder path
+# Suffix of the index saved next to each per-pair CSV file by dydx_data_processing.py
+INDEX_SUFFIX = ".idx"
+
+def calendar_dates(df, date_column):
+    # Convert the date column to datetime format
+    df[date_column] = pd.to_datetime(df[date_column], errors="coerce")
+
+    # Compare calendar dates only, using the wall time of timezone-aware columns
+    dates = df[date_column]
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    return dates.dt.normalize()
+
+def filter_dates(df, date_column, start_date, end_date, dates=None):
+    # Parse the dates, unless they were parsed once for several date ranges
+    if dates is None:
+        dates = calendar_dates(df, date_column)
+
+    # Keep rows within the specified date range or blank rows with a single boolean mask
+    in_range = (dates >= pd.Timestamp(start_date.date())) & (
+        dates <= pd.Timestamp(end_date.date())
+    )
+    filtered_df = df[dates.isnull() | in_range]
+
+    if filtered_df.empty:  # Nothing is left between the dates
+        return None
+
+    # Set the date column as the index
+    filtered_df = filtered_df.set_index(date_column)
+
+    # Remove 'Unnamed: 0' column if it exists
+    if "Unnamed: 0" in filtered_df.columns:
+        filtered_df.drop("Unnamed: 0", axis=1, inplace=True)
+
+    if "Block" in filtered_df.columns:
+        # Count occurrences of values in the 'Block' column
+        block_counts = filtered_df["Block"].value_counts()
+
+        # Find start and end of recurring block values
+        recurring_blocks = block_counts.index[block_counts > 1]
+
+        # Filter rows based on recurring block values, nothing is left without any
+        if len(recurring_blocks) > 0:
+            filtered_df = filtered_df[
+                (filtered_df["Block"] >= recurring_blocks.min())
+                & (filtered_df["Block"] <= recurring_blocks.max())
+            ]
+        else:
+            filtered_df = filtered_df.iloc[0:0]
+
+        if not filtered_df.empty:
+
+            # Check if the first row has NaN values for every column except 'Block'
+            if filtered_df.iloc[0].drop("Block").isnull().all():
+
+                # Drop the first row if all values except 'Block' are NaN
+                filtered_df = filtered_df.iloc[1:]
+
+    return filtered_df
+
+def save_filtered(filtered_df, filtered_file_path, start_date, end_date, filename):
+    if filtered_df is None:
+        print(f"No data found between {start_date} and {end_date} in {filename}")
+    elif not filtered_df.empty:  # Check if there are rows left after further processing
+        filtered_df.to_csv(filtered_file_path)  # Save filtered DataFrame to a new CSV file
+        print(f"Filtered file saved as: {filtered_file_path}")
+    else:
+        print(f"No data left after processing in {filename}")
+
+def rebuild_index(file_path):
+    # The index is written by dydx_data_processing.py, which is only imported to rebuild one
+    from dydx_data_processing import ProcessedTrades
+
+    # Read the file as it was written, with the end of each line for the byte offsets
+    with open(file_path, "rb") as f:
+        data = f.read()
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n")) + 1
+    df = pd.read_csv(io.BytesIO(data), index_col=0, skip_blank_lines=False)
+    ProcessedTrades().save_csv_index(df, line_ends, len(data), file_path)
+
+def read_indexed(file_path, start_date, end_date):
+    # Use the index saved next to the file, unless there is none
+    index_path = f"{file_path}{INDEX_SUFFIX}"
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        index = json.load(f)
+
+    # Rebuild it when the size or modification time of the file changed since it was written
+    stat = os.stat(file_path)
+    if index["size"] != stat.st_size or index.get("mtime_ns") != stat.st_mtime_ns:
+        rebuild_index(file_path)
+        with open(index_path) as f:
+            index = json.load(f)
+
+    segments = pd.DataFrame(index["segments"])
+    blocks = segments["block"].notnull().all()
+
+    # Rows without a date are always kept when there are no blocks to trim them, so read them all
+    if index["blank_rows"] and not blocks:
+        return None
 
+    # Find the segments with dates between the start and end dates, by calendar date
+    first_dates = pd.to_datetime(segments["start_date"]).dt.normalize()
+    last_dates = pd.to_datetime(segments["end_date"]).dt.normalize()
+    overlapping = segments.index[
+        (last_dates >= pd.Timestamp(start_date.date()))
+        & (first_dates <= pd.Timestamp(end_date.date()))
+    ]
+
+    # Without any, a segment starting with a separator row leaves the same empty result,
+    # the separator is kept as a blank row and then trimmed with its incomplete block
+    if overlapping.empty and index["blank_rows"]:
+        overlapping = segments.index[min(1, len(segments) - 1) :][:1]
+
+    # Read the header and the bytes of the segments, blocks are never split
+    with open(file_path, "rb") as f:
+        data = f.read(index["header_end"])
+        if not overlapping.empty:
+            start = segments["byte_start"].iloc[overlapping[0]]
+            end = (
+                segments["byte_start"].iloc[overlapping[-1] + 1]
+                if overlapping[-1] + 1 < len(segments)
+                else index["size"]
+            )
+            f.seek(start)
+            data += f.read(end - start)
+
+    return pd.read_csv(io.BytesIO(data), skip_blank_lines=False)
+
+def window_dir(name, start_date, end_date):
     # Generate a name for the output directory based on folder name, start date, and end date
-    output_dir = f"{folder_name}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}" 
+    return f"{name}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}"
+
+def filter_csv_file(folder_path, filename, windows, output_dirs):
+    file_path = os.path.join(folder_path, filename)  # Get the full file path
+
+    # Read only the blocks between the first and last dates of the windows when the file
+    # has an index, otherwise all of it, once for every window
+    df = read_indexed(
+        file_path,
+        min(start_date for start_date, _ in windows),
+        max(end_date for _, end_date in windows),
+    )
+    if df is None:
+        df = pd.read_csv(file_path, skip_blank_lines=False)  # Read CSV file into a DataFrame
+
+    # Check for the presence of date column either named 'Date' or 'Koinly Date'
+    date_column = None
+    for col in ["Date", "Koinly Date"]:
+        if col in df.columns:
+            date_column = col  # Found the date column
+            break
+
+    if date_column is None:
+        print(f"Date column not found in {filename}")
+        return
+
+    # Parse the dates once, then save the rows of each window to its own directory
+    dates = calendar_dates(df, date_column)
+    for (start_date, end_date), output_dir in zip(windows, output_dirs):
+        filtered_df = filter_dates(df, date_column, start_date, end_date, dates)
+        save_filtered(
+            filtered_df, os.path.join(output_dir, filename), start_date, end_date, filename
+        )
+
+def filter_csv_windows(folder_path, windows, max_workers=None):
+    # Create a directory to save the filtered files of each window
+    folder_name = os.path.basename(folder_path)  # Extract the folder name from the folder path
+    output_dirs = [
+        window_dir(folder_name, start_date, end_date) for start_date, end_date in windows
+    ]
+    for output_dir in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
 
-    # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)  
+    # Filter the CSV files in the specified folder at the same time, each read once
+    filenames = [filename for filename in os.listdir(folder_path) if filename.endswith(".csv")]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(filter_csv_file, folder_path, filename, windows, output_dirs)
+            for filename in filenames
+        ]
+        for future in futures:
+            future.result()
 
-    # Loop through each file in the specified folder
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".csv"):  # Check if the file is a CSV file
-            file_path = os.path.join(folder_path, filename)  # Get the full file path
-            df = pd.read_csv(file_path, skip_blank_lines=False)  # Read CSV file into a DataFrame
+def filter_csv_files(folder_path, start_date, end_date, max_workers=None):
+    filter_csv_windows(folder_path, [(start_date, end_date)], max_workers)
 
-            # Check for the presence of date column either named 'Date' or 'Koinly Date'
-            date_column = None
-            for col in ["Date", "Koinly Date"]:
-                if col in df.columns:
-                    date_column = col  # Found the date column
-                    break
+def filter_store(store_dir, start_date, end_date, columns=None):
+    filter_store_windows(store_dir, [(start_date, end_date)], columns)
 
+def filter_store_windows(store_dir, windows, columns=None):
+    # The Parquet store is only read when it is used
+    from dydx_data_processing import ProcessedTrades
+
+    processed_trades = ProcessedTrades(store_dir=store_dir)
+
+    # Generate a name for the output directory of each window based on the store name
+    store_name = os.path.basename(os.path.normpath(store_dir))
+    output_dirs = [
+        window_dir(store_name, start_date, end_date) for start_date, end_date in windows
+    ]
+
+    # Loop through each dataset in the store, reading only the years and rows between the
+    # first and last dates of the windows, once for every window
+    for dataset in sorted(os.listdir(store_dir)):
+        data = processed_trades.read_store(
+            dataset,
+            min(start_date for start_date, _ in windows),
+            max(end_date for _, end_date in windows),
+            columns=columns,
+            years=True,
+        )
+
+        # Per-pair datasets are saved as a folder with one file per pair
+        if isinstance(data, dict):
+            files = [(df, os.path.join(dataset, f"{pair}.csv")) for pair, df in data.items()]
+        else:
+            files = [(data, f"{dataset}.csv")]
+
+        for df, filename in files:
+            # The date column is the index, except for the numbered rows of the trade data
+            date_column = df.index.name
             if date_column is None:
-                print(f"Date column not found in {filename}")
-                continue
-
-            # Convert the date column to datetime format
-            df[date_column] = pd.to_datetime(df[date_column], errors="coerce")
-
-            # Iterate over each row and keep track of rows within the specified date range or blank rows
-            filtered_rows = []
-            for i, row in df.iterrows():
-                if pd.isnull(row[date_column]) or (
-                    row[date_column].date() >= start_date.date()
-                    and row[date_column].date() <= end_date.date()
-                ):
-                    filtered_rows.append(row)
-
-            # Create a DataFrame with filtered rows
-            filtered_df = pd.DataFrame(filtered_rows)
-
-            if not filtered_df.empty:  # Check if there are rows left after filtering
-                # Set the date column as the index
-                filtered_df.set_index(date_column, inplace=True)
-
-                # Remove 'Unnamed: 0' column if it exists
-                if "Unnamed: 0" in filtered_df.columns:
-                    filtered_df.drop("Unnamed: 0", axis=1, inplace=True)
-
-                if "Block" in filtered_df.columns:
-                    # Count occurrences of values in the 'Block' column
-                    block_counts = Counter(filtered_df["Block"])
-
-                    # Find start and end of recurring block values
-                    start_block, end_block = None, None
-                    for block, count in block_counts.items():
-                        if count > 1:
-                            if start_block is None or block < start_block:
-                                start_block = block
-                            if end_block is None or block > end_block:
-                                end_block = block
-
-                    # Filter rows based on recurring block values
-                    filtered_df = filtered_df[
-                        (filtered_df["Block"] >= start_block)
-                        & (filtered_df["Block"] <= end_block)
-                    ]
-
-                    if not filtered_df.empty:
-
-                        # Check if the first row has NaN values for every column except 'Block'
-                        if filtered_df.iloc[0].drop("Block").isnull().all():
-
-                            # Drop the first row if all values except 'Block' are NaN
-                            filtered_df = filtered_df.iloc[1:]
-
-                if not filtered_df.empty:  # Check if there are rows left after further processing
-                    filtered_file_path = os.path.join(output_dir, f"{filename}")
-                    filtered_df.to_csv(filtered_file_path)  # Save filtered DataFrame to a new CSV file
-                    print(f"Filtered file saved as: {filtered_file_path}")
-                else:
-                    print(f"No data left after processing in {filename}")
+                df = df.reset_index(drop=True)
+                date_column = "Koinly Date" if "Koinly Date" in df.columns else "Date"
             else:
-                print(f"No data found between {start_date} and {end_date} in {filename}")
+                df = df.reset_index()
+
+            # Parse the dates once, then save the rows of each window to its own directory
+            years = df.pop("year")
+            dates = calendar_dates(df, date_column)
+            for (start_date, end_date), output_dir in zip(windows, output_dirs):
+                filtered_file_path = os.path.join(output_dir, filename)
+                os.makedirs(os.path.dirname(filtered_file_path), exist_ok=True)
+
+                # Keep the years the window would have read from the store on its own, which
+                # include the separator rows stored with the trades before them
+                in_years = years.between(
+                    start_date.year, (end_date.normalize() + pd.Timedelta(days=1)).year
+                )
+                filtered_df = filter_dates(
+                    df[in_years], date_column, start_date, end_date, dates[in_years]
+                )
+                if filtered_df is not None:
+                    filtered_df = processed_trades.format_decimals(filtered_df)
+
+                    # The pairs are read for their decimals even when they are not asked for
+                    if columns is not None and "Pair" not in columns:
+                        filtered_df = filtered_df.drop(columns="Pair", errors="ignore")
+                save_filtered(filtered_df, filtered_file_path, start_date, end_date, filename)
+
+def filter_path(
+    folder_path, start_date=None, end_date=None, columns=None, windows=(), max_workers=None
+):
+    # Filter one date range, several ones from a single read of each file, or both
+    windows = [
+        (pd.to_datetime(start_date), pd.to_datetime(end_date)) for start_date, end_date in windows
+    ]
+    if start_date is not None:
+        windows.insert(0, (pd.to_datetime(start_date), pd.to_datetime(end_date)))
+
+    # Filter the CSV files within the specified date ranges, or the Parquet store
+    if os.path.isdir(folder_path) and any(
+        name.endswith(".csv") for name in os.listdir(folder_path)
+    ):
+        filter_csv_windows(folder_path, windows, max_workers)
+    else:
+        filter_store_windows(folder_path, windows, columns)
 
 if __name__ == "__main__":
 
-    # Get input folder path and date range from user
-    folder_path = input("Enter the folder path containing CSV files: ")
-    start_date = pd.to_datetime(input("Enter the start date (YYYY-MM-DD): "))
-    end_date = pd.to_datetime(input("Enter the end date (YYYY-MM-DD): "))
+    # Take the folder path and date range from the command line
+    from dydx_cli import main
 
-    # Call the function to filter CSV files within the specified date range
-    filter_csv_files(folder_path, start_date, end_date)
+    main(["filter", *sys.argv[1:]])
@@ -0,0 +1,292 @@
+import argparse
+import os
+import sys
+
+
+# Pipeline stages, in the order of PIPELINE_STAGES in dydx_data_processing.py
+# They are listed here so the help is shown without importing pandas and pyarrow
+STAGES = [
+    "Transfers",
+    "Deposit_Swaps",
+    "Funding",
+    "Trades",
+    "Blocks",
+    "Buy_Side_Loans",
+    "Sell_Side_Loans",
+    "Loans",
+    "Trade_Data",
+    "Buy_Side_Data",
+    "Sell_Side_Data",
+]
+
+
+# Function to check a stage name given on the command line
+def stage_name(value):
+    if value not in STAGES:
+        raise argparse.ArgumentTypeError(
+            f"invalid stage {value!r}, choose from {', '.join(STAGES)}"
+        )
+    return value
+
+
+# Function to check a date range given on the command line as START:END
+def date_window(value):
+    start_date, separator, end_date = value.partition(":")
+    if not separator or not start_date or not end_date:
+        raise argparse.ArgumentTypeError(
+            f"invalid date range {value!r}, use START:END such as 2021-01-01:2021-12-31"
+        )
+    return start_date, end_date
+
+
+# Function to add the options shared by the commands running pipeline stages
+def add_pipeline_options(parser):
+    parser.add_argument("--input-dir", default="Original_Files", help="folder with the dYdX exports")
+    parser.add_argument("--output-root", default=".", help="folder to write the outputs to")
+    parser.add_argument(
+        "--formats", nargs="+", choices=["csv", "parquet"], default=["csv"],
+        help="write the CSV files, the Parquet store or both",
+    )
+    parser.add_argument("--workers", type=int, help="processes used for the pairs")
+    parser.add_argument("--threads", type=int, help="stages run at the same time")
+    parser.add_argument("--compact", action="store_true", help="keep repeated text as categoricals")
+    parser.add_argument(
+        "--csv-writer", choices=["pandas", "arrow"], default="pandas",
+        help="writer of the CSV files, both write the same bytes",
+    )
+    parser.add_argument(
+        "--backend", choices=["pandas", "arrow"], default="pandas",
+        help="library running the stages, both give the same results",
+    )
+    parser.add_argument(
+        "--funding-chunksize", type=int,
+        help="read Funding.csv in chunks of this many rows, keeping only the daily totals",
+    )
+    parser.add_argument(
+        "--by-market", action="store_true",
+        help="also save the daily funding per market as dYdX_Funding_By_Market.csv",
+    )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="save the time, rows and memory of each stage as Profile.json",
+    )
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="check the output files afterwards and fail if they disagree",
+    )
+    parser.add_argument(
+        "--cache-dir", help="folder caching parsed exports and results for unchanged reruns"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=2048, help="size of the cache in MB, default 2048"
+    )
+
+
+# Function to run the pipeline, or only the stages needed for the targets
+def run_command(args, targets=None):
+    from dydx_data_processing import run_pipeline
+
+    run_pipeline(
+        input_dir=args.input_dir,
+        output_root=args.output_root,
+        workers=args.workers,
+        formats=tuple(args.formats),
+        profile=args.profile,
+        targets=targets or None,
+        threads=args.threads,
+        compact=args.compact,
+        csv_writer=args.csv_writer,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size * 2**20,
+        backend=args.backend,
+        funding_chunksize=args.funding_chunksize,
+        funding_by_market=args.by_market,
+    )
+    if args.verify:
+        verify_command(args)
+
+
+# Function to check the output files of a run, exiting with an error when they disagree
+def verify_command(args):
+    from dydx_data_processing import ProcessedTrades
+
+    processed_trades = ProcessedTrades(
+        input_dir=args.input_dir, output_dir=os.path.join(args.output_root, "Output")
+    )
+    report = processed_trades.verify_outputs(
+        os.path.join(args.output_root, "Trade_Data"),
+        os.path.join(args.output_root, "Verification.csv"),
+    )
+    if not report.empty:
+        sys.exit(1)
+
+
+# Function to process the new trades since the last run from the saved checkpoints
+def incremental_command(args):
+    from dydx_data_processing import ProcessedTrades
+
+    processed_trades = ProcessedTrades(
+        input_dir=args.input_dir,
+        output_dir=os.path.join(args.output_root, "Output"),
+        compact=args.compact,
+        csv_writer=args.csv_writer,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size * 2**20,
+        backend=args.backend,
+    )
+    processed_trades.process_file("Trades", processed_trades.process_trades, "Trades")
+    processed_trades.process_incremental(
+        os.path.join(args.output_root, "Checkpoints"),
+        os.path.join(args.output_root, "Trade_Data"),
+        os.path.join(args.output_root, "Buy_Side_Data"),
+        os.path.join(args.output_root, "Sell_Side_Data"),
+    )
+    processed_trades.merge_loans(return_frames=False)
+    if args.verify:
+        verify_command(args)
+
+
+# Function to process a large trades export in chunks of rows, with one chunk in memory
+def stream_command(args):
+    from dydx_data_processing import ProcessedTrades
+
+    processed_trades = ProcessedTrades(
+        input_dir=args.input_dir,
+        output_dir=os.path.join(args.output_root, "Output"),
+        compact=args.compact,
+        csv_writer=args.csv_writer,
+        backend=args.backend,
+    )
+    processed_trades.process_trades_file(
+        "Trades",
+        "Trades",
+        args.chunksize,
+        os.path.join(args.output_root, "Checkpoints"),
+        os.path.join(args.output_root, "Trade_Data"),
+        os.path.join(args.output_root, "Buy_Side_Data"),
+        os.path.join(args.output_root, "Sell_Side_Data"),
+    )
+    processed_trades.merge_loans(return_frames=False)
+    if args.verify:
+        verify_command(args)
+
+
+# Function to process the given account folders as a batch
+def batch_command(args):
+    from dydx_data_processing import run_batch
+
+    run_batch(args.paths, args.output_root, args.max_workers, tuple(args.formats))
+
+
+# Function to keep the rows between two dates, or of several date ranges, of a folder of
+# CSV files or a Parquet store
+def filter_command(args):
+    from csv_date_filter import filter_path
+
+    filter_path(
+        args.path, args.start_date, args.end_date, args.columns, args.windows, args.workers
+    )
+
+
+# Function to write a dataset of the Parquet store as Koinly CSV files
+def export_command(args):
+    from dydx_data_processing import ProcessedTrades
+
+    processed_trades = ProcessedTrades(store_dir=args.store_dir)
+    processed_trades.export_store(
+        args.dataset, args.output_path, args.start_date, args.end_date, args.pairs
+    )
+
+
+# Function to build the parser of every command
+def build_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Turn dYdX exports into Koinly CSV files, one stage or all of them"
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    run = commands.add_parser("run", help="run the full pipeline, or the stages needed for the targets")
+    run.add_argument("targets", nargs="*", type=stage_name, metavar="stage", help=", ".join(STAGES))
+    add_pipeline_options(run)
+    run.set_defaults(handler=lambda args: run_command(args, args.targets))
+
+    # One command per stage, running the stages it needs as well
+    for stage in STAGES:
+        command = commands.add_parser(
+            stage.lower().replace("_", "-"), help=f"run the {stage} stage and the stages it needs"
+        )
+        add_pipeline_options(command)
+        command.set_defaults(handler=lambda args, stage=stage: run_command(args, [stage]))
+
+    incremental = commands.add_parser(
+        "incremental", help="process only the trades added since the last checkpoints"
+    )
+    add_pipeline_options(incremental)
+    incremental.set_defaults(handler=incremental_command)
+
+    stream = commands.add_parser(
+        "stream", help="process Trades.csv in chunks of rows, for exports larger than memory"
+    )
+    add_pipeline_options(stream)
+    stream.add_argument("--chunksize", type=int, default=100000, help="rows read at a time")
+    stream.set_defaults(handler=stream_command)
+
+    batch = commands.add_parser("batch", help="process several account folders in parallel")
+    batch.add_argument("paths", nargs="+", help="account folders, or folders holding them")
+    batch.add_argument("--output-root", default="Accounts")
+    batch.add_argument("--max-workers", type=int)
+    batch.add_argument("--formats", nargs="+", choices=["csv", "parquet"], default=["csv"])
+    batch.set_defaults(handler=batch_command)
+
+    verify = commands.add_parser(
+        "verify", help="check that the output files agree with each other and the exports"
+    )
+    verify.add_argument("--input-dir", default="Original_Files", help="folder with the dYdX exports")
+    verify.add_argument("--output-root", default=".", help="folder with the outputs")
+    verify.set_defaults(handler=verify_command)
+
+    date_filter = commands.add_parser(
+        "filter", help="keep the rows between two dates of a CSV folder or Parquet store"
+    )
+    date_filter.add_argument("path", help="folder of CSV files or Parquet store")
+    date_filter.add_argument("start_date", nargs="?", help="first date kept, YYYY-MM-DD")
+    date_filter.add_argument("end_date", nargs="?", help="last date kept, YYYY-MM-DD")
+    date_filter.add_argument(
+        "--windows", nargs="+", type=date_window, default=[], metavar="START:END",
+        help="more date ranges, each saved to its own folder from one read of every file",
+    )
+    date_filter.add_argument("--workers", type=int, help="CSV files filtered at the same time")
+    date_filter.add_argument("--columns", nargs="+", help="columns read from the Parquet store")
+    date_filter.set_defaults(handler=filter_command)
+
+    export = commands.add_parser("export", help="write a dataset of the Parquet store as CSV")
+    export.add_argument("dataset", help="dataset name, such as dYdX_Trades or Trade_Data")
+    export.add_argument("output_path", help="CSV file, or folder for per-pair datasets")
+    export.add_argument("--store-dir", default="Store")
+    export.add_argument("--start-date")
+    export.add_argument("--end-date")
+    export.add_argument("--pairs", nargs="+")
+    export.set_defaults(handler=export_command)
+
+    return parser
+
+
+# Function to run a command, the full pipeline when none is given
+def main(argv=None):
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["run"])
+
+    if args.command == "filter" and (
+        args.end_date is None and (args.start_date is not None or not args.windows)
+    ):
+        parser.error("filter needs a start and end date, or --windows")
+
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,2681 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import io
 import os
+import glob
+import hashlib
+import shutil
+import sys
+import json
+import time
+import traceback
+import tracemalloc
+import functools
+import contextlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from itertools import chain, repeat
 from datetime import timedelta
 
 
-class ProcessedTrades:
-    def __init__(self):
-        # Initialize dictionaries to hold different types of processed data
-        self.trade_data = {}  # Holds processed trade data
-        self.buy_side_data = {}  # Holds processed buy-side loan data
-        self.sell_side_data = {}  # Holds processed sell-side loan data
+# Columns and types of the dYdX export files, only these columns are read
+# Timestamps are kept as strings here and parsed by the processing functions, and so are
+# trade and funding numbers, which are converted to exact scaled integers
+SCHEMAS = {
+    "Trades": {
+        "createdAt": "str",
+        "side": "str",
+        "market": "str",
+        "price": "str",
+        "size": "str",
+        "fee": "str",
+    },
+    "Funding": {
+        "effectiveAt": "str",
+        "market": "str",
+        "payment": "str",
+    },
+    "Transfers": {
+        "createdAt": "str",
+        "type": "str",
+        "debitAsset": "str",
+        "creditAsset": "str",
+        "debitAmount": "float64",
+        "creditAmount": "float64",
+        "transactionHash": "str",
+        "status": "str",
+        "confirmedAt": "str",
+        "fromAddress": "str",
+        "toAddress": "str",
+    },
+}
+
+# Columns identifying a row of each export file, the first one is its time
+# Rows with the same values in overlapping exports are the same trade, payment or transfer
+KEY_COLUMNS = {
+    "Trades": ["createdAt", "market", "side", "size", "price", "fee"],
+    "Funding": ["effectiveAt", "market"],
+    "Transfers": ["createdAt", "type", "transactionHash", "debitAmount", "creditAmount"],
+}
+
+# Columns with few distinct values, read as categoricals in compact mode
+CATEGORICAL_COLUMNS = {
+    "Trades": ["side", "market"],
+}
+
+# Columns some exports leave out, read as missing values from the exports without them
+OPTIONAL_COLUMNS = {
+    "Funding": ["market"],
+    "Transfers": ["status", "confirmedAt", "fromAddress", "toAddress"],
+}
+
+# Columns of the Koinly loan files, after their Date index
+LOAN_COLUMNS = [
+    "Received Amount",
+    "Received Currency",
+    "Sent Amount",
+    "Sent Currency",
+    "Label",
+]
+
+# Rows of each pair's loans read at a time when the loans of all pairs are merged
+LOAN_MERGE_ROWS = 4096
+
+# Number of decimals of USDC, the currency of prices, fees and funding payments
+USDC_DECIMALS = 6
+
+# Integer columns of the trade data, scaled by the decimals of their pair's sizes and prices
+SCALED_COLUMNS = ["Amount", "Price", "Fee Amount", "Total", "Running Sum"]
+
+# Cells per chunk of rows written to CSV at a time, as pandas does, so both writers
+# choose the same date format for each chunk
+CSV_CHUNK_CELLS = 100000
+
+# Version of the files kept in the cache, raised when their layout changes, and the default
+# size of the cache in bytes, above which the least recently used entries are removed
+CACHE_VERSION = 1
+CACHE_SIZE = 2 * 2**30
+
+# Suffix of the index saved next to each per-pair CSV file, and the rows per indexed
+# segment of files without blocks
+INDEX_SUFFIX = ".idx"
+INDEX_SEGMENT_ROWS = 1024
+
+
+# Function to count the rows of a DataFrame or Arrow table, or of those in a dictionary or tuple
+def count_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, pa.Table)):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (tuple, list)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+# Function to hash the source of this module, so results cached by other code are not used
+@functools.lru_cache(maxsize=None)
+def code_version():
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Function to get the context starting worker processes, from a server process without threads where
+# the platform has one, so no lock held by a thread of this process, such as a running stage's, is
+# copied into the workers locked
+def process_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+# Decorator to record a stage of ProcessedTrades when its profiler is enabled
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler is None:
+            return func(self, *args, **kwargs)
+        return self.profiler.run(func, self, args, kwargs)
+
+    return wrapper
+
+
+class StageProfiler:
+    def __init__(self):
+        # Records of the finished stages and the stack of the running ones
+        self.records = []
+        self.stack = []
+
+        # Trading pair the running stages work on
+        self.pair = None
+
+        # Trace the allocations to find the peak memory of each stage, and of the whole run
+        # across the resets of the traced peak at the start of every stage
+        self.peak = 0
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+
+
+    # Function to run a stage, recording its wall time, rows in and out and peak memory
+    def run(self, func, owner, args, kwargs):
+
+        # Name the stage after the function and its first text argument, e.g. a file name
+        label = next((arg for arg in args if isinstance(arg, str)), None)
+        record = {
+            "stage": func.__name__,
+            "label": label,
+            "pair": self.pair,
+            "depth": len(self.stack),
+            "top": not self.stack or self.stack[-1]["pair"] != self.pair,
+            "rows_in": count_rows(list(args) + list(kwargs.values())),
+        }
+
+        # Every running stage has seen the peak so far, then measure this stage's own peak
+        current, peak = tracemalloc.get_traced_memory()
+        for parent in self.stack:
+            parent["peak"] = max(parent["peak"], peak)
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        record["peak"] = current
+        record["start_memory"] = current
+
+        self.stack.append(record)
+        start = time.perf_counter()
+        try:
+            value = func(owner, *args, **kwargs)
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self.stack.pop()
+            record["peak"] = max(record["peak"], tracemalloc.get_traced_memory()[1])
+            for parent in self.stack:
+                parent["peak"] = max(parent["peak"], record["peak"])
+            self.records.append(record)
+
+        record["rows_out"] = count_rows(value)
+        return value
+
+
+    # Context manager to attribute the stages run inside it to a trading pair
+    @contextlib.contextmanager
+    def for_pair(self, pair):
+        previous, self.pair = self.pair, pair
+        try:
+            yield
+        finally:
+            self.pair = previous
+
+
+    # Function to add the records of stages run by a worker process
+    def add_records(self, records, pair):
+        for record in records:
+            self.records.append(
+                {
+                    **record,
+                    "pair": pair,
+                    "depth": record["depth"] + len(self.stack),
+                }
+            )
+
+
+    # Function to build the report, the stages in the order they finished
+    def report(self):
+
+        stages = [
+            {
+                "stage": record["stage"],
+                "label": record["label"],
+                "pair": record["pair"],
+                "depth": record["depth"],
+                "seconds": round(record["seconds"], 6),
+                "rows_in": record["rows_in"],
+                "rows_out": record.get("rows_out"),
+                "peak_memory_mb": round(record["peak"] / 2**20, 3),
+                "added_memory_mb": round(
+                    (record["peak"] - record["start_memory"]) / 2**20, 3
+                ),
+            }
+            for record in self.records
+        ]
+
+        # Totals per stage, and per pair over the outermost stages run for each pair
+        df = pd.DataFrame(stages, columns=list(stages[0]) if stages else ["stage"])
+        summary = []
+        if stages:
+            df[["rows_in", "rows_out"]] = df[["rows_in", "rows_out"]].astype("Int64")
+            summary = (
+                df.fillna({"label": ""})
+                .groupby(["stage", "label"], sort=False)
+                .agg(
+                    calls=("seconds", "size"),
+                    seconds=("seconds", "sum"),
+                    rows_in=("rows_in", lambda rows: rows.sum(min_count=1)),
+                    rows_out=("rows_out", lambda rows: rows.sum(min_count=1)),
+                    peak_memory_mb=("peak_memory_mb", "max"),
+                )
+                .reset_index()
+            )
+            summary = summary.astype(object).where(summary.notna(), None)
+            summary = summary.to_dict("records")
+        tops = [record for record in self.records if record["pair"] and record["top"]]
+        pairs = {}
+        for record in tops:
+            pairs[record["pair"]] = round(
+                pairs.get(record["pair"], 0) + record["seconds"], 6
+            )
+
+        return {
+            "total_seconds": round(time.perf_counter() - self.start, 6),
+            "peak_memory_mb": round(
+                max(
+                    [
+                        self.peak,
+                        tracemalloc.get_traced_memory()[1],
+                        *(record["peak"] for record in self.records),
+                    ]
+                )
+                / 2**20,
+                3,
+            ),
+            "summary": summary,
+            "pairs": dict(sorted(pairs.items(), key=lambda item: -item[1])),
+            "stages": stages,
+        }
+
+
+    # Function to save the report as JSON and print a summary of it
+    def save(self, file_name, top_pairs=10):
+
+        report = self.report()
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        with open(file_name, "w") as file:
+            json.dump(report, file, indent=2, default=int)
+
+        print(f"Profile saved as: {file_name}")
+        print(
+            f"Total {report['total_seconds']:.3f}s, peak memory {report['peak_memory_mb']:.1f} MB"
+        )
+        if report["summary"]:
+            print(
+                pd.DataFrame(report["summary"])
+                .astype({"rows_in": "Int64", "rows_out": "Int64"})
+                .to_string(index=False, float_format="{:.3f}".format, na_rep="")
+            )
+        if report["pairs"]:
+            print("\nSlowest pairs:")
+            for pair, seconds in list(report["pairs"].items())[:top_pairs]:
+                print(f"  {pair:<16}{seconds:>10.3f}s")
+
+        # Stop tracing the allocations if this profiler started it
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        return report
+
+
+class ProcessedTrades:
+    def __init__(
+        self,
+        input_dir="Original_Files",
+        output_dir="Output",
+        store_dir=None,
+        write_csv=True,
+        profile=False,
+        compact=False,
+        lazy=False,
+        pair_cache_size=16,
+        csv_writer="pandas",
+        write_workers=4,
+        cache_dir=None,
+        cache_size=CACHE_SIZE,
+        backend="pandas",
+        funding_chunksize=None,
+        funding_by_market=False,
+    ):
+        # Directories holding the original exports and the Koinly output files
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+
+        # Optional Parquet store written next to, or instead of, the CSV files
+        self.store_dir = store_dir
+        self.write_csv = write_csv
+
+        # Initialize dictionaries to hold different types of processed data
+        self.trade_data = {}  # Holds processed trade data
+        self.buy_side_data = {}  # Holds processed buy-side loan data
+        self.sell_side_data = {}  # Holds processed sell-side loan data
+
+        # Loan files of the pairs written by incremental and streamed runs, merged from disk
+        self.buy_side_files = {}
+        self.sell_side_files = {}
+
+        # Number of decimals by which each integer trade column is scaled, for every pair
+        # Trades without a pair are kept under None
+        self.decimals = {}
+
+        # Export files parsed once and shared by the stages reading them, with the reads left
+        self.inputs = {}
+        self.input_uses = {}
+        self.input_locks = {}
+
+        # Optional profiler recording the time, rows and memory of each stage
+        self.profiler = StageProfiler() if profile else None
+
+        # Keep repeated text columns as categoricals to reduce the memory of large accounts
+        self.compact = compact
+
+        # In lazy mode access_data processes a pair only when it is first asked for,
+        # keeping the results of the most recently used pairs
+        self.lazy = lazy
+        self.pair_cache = OrderedDict()
+        self.pair_cache_size = pair_cache_size
+        self.lazy_trades = None
+
+        # CSV files are written with "pandas" or the faster "arrow" writer, with the same bytes,
+        # by a bounded pool of threads
+        self.csv_writer = csv_writer
+        self.write_workers = write_workers
+
+        # Optional cache of parsed exports and results, keyed by the hash of what they depend on
+        # The file hashes are remembered while a file keeps its size and modification time
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.cache_used = set()
+        self.file_digests = {}
+
+        # Stage functions are run by the "pandas" backend or the "arrow" one, with the same results
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, choose from {', '.join(BACKENDS)}")
+        self.backend_name = backend
+        self.backend = BACKENDS[backend](self)
+
+        # The funding stage reads the export in chunks of rows when a chunk size is set, keeping
+        # only the daily totals in memory, and can save the daily funding per market as well
+        self.funding_chunksize = funding_chunksize
+        self.funding_by_market = funding_by_market
+
+
+    # Function to attribute the profiled stages run inside it to a trading pair
+    def profile_pair(self, pair):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.for_pair(pair)
+
+
+    # Function to save the profile of the stages run so far as JSON and print its summary
+    def save_profile(self, file_name="Profile.json"):
+        return self.profiler.save(file_name)
+
+
+    # Function to read an export file with its declared schema
+    def read_input(self, file_name):
+
+        file_path = self.export_file(file_name)
+
+        # Files without a declared schema are read with type inference
+        if file_name not in SCHEMAS:
+            return pd.read_csv(file_path)
+
+        # Every read gets its own DataFrame, the processing functions change them in place
+        return self.read_table(file_name).to_pandas()
+
+
+    # Function to parse an export file with its declared schema into an Arrow table
+    def read_table(self, file_name):
+
+        # Parse each file once when several stages read it, the last read releases it
+        with self.input_locks.setdefault(file_name, threading.Lock()):
+            table = self.inputs.pop(file_name, None)
+            if table is None:
+                table = self.parse_input(file_name)
+
+            uses = self.input_uses.pop(file_name, 1) - 1
+            if uses > 0:
+                self.inputs[file_name] = table
+                self.input_uses[file_name] = uses
+
+        return table
+
+
+    # Function to parse the export files of a type, or to load them from the cache when files
+    # with the same content were parsed before
+    def parse_input(self, file_name):
+
+        file_paths = self.export_files(file_name)
+
+        key = None
+        if self.cache_dir is not None:
+            key = self.cache_key(
+                "input",
+                file_name,
+                self.compact,
+                [self.file_digest(path) for path in file_paths],
+            )
+            entry = self.cache_entry(key)
+            if entry is not None:
+                return self.load_table(os.path.join(entry, "table.arrow"))
+
+        # Read only the declared columns with the multithreaded pyarrow parser,
+        # merging the exports when there are several overlapping ones
+        if len(file_paths) > 1:
+            table = self.merge_exports(file_name, file_paths)
+        else:
+            table = self.read_export(file_name, self.export_file(file_name))
+
+        if key is not None:
+            self.save_cache_entry(
+                key, lambda entry: self.save_table(table, os.path.join(entry, "table.arrow"))
+            )
+        return table
+
+
+    # Function to list the export files of a type, such as Trades.csv and Trades_2022.csv
+    def export_files(self, file_name):
+        return sorted(
+            glob.glob(os.path.join(glob.escape(self.input_dir), f"{file_name}*.csv"))
+        )
+
+
+    # Function to find the export file of a type read on its own, the only one found even when
+    # its name has a suffix such as Trades_2023.csv
+    def export_file(self, file_name):
+        file_paths = self.export_files(file_name)
+        if len(file_paths) == 1:
+            return file_paths[0]
+        return os.path.join(self.input_dir, f"{file_name}.csv")
+
+
+    # Function to merge overlapping export files of a type into one table, newest rows first
+    # Each file is read once and only its rows not seen in the files before it are kept
+    def merge_exports(self, file_name, file_paths):
+
+        key_columns = KEY_COLUMNS[file_name]
+        tables = [self.read_export(file_name, path) for path in file_paths]
+
+        # Start with the most recent exports, so their rows are kept with their latest status
+        newest = [pc.max(table[key_columns[0]]).as_py() or "" for table in tables]
+        tables = [
+            table
+            for _, table in sorted(
+                zip(newest, tables), key=lambda item: item[0], reverse=True
+            )
+        ]
+
+        # Hash index of the rows kept so far
+        seen = np.array([], dtype=np.uint64)
+        parts = []
+        times = []
+        for table in tables:
+            keys = self.row_keys(table.select(key_columns))
+            new = ~pd.Series(keys).isin(seen).to_numpy()
+            seen = np.concatenate([seen, keys[new]])
+
+            # Exports list the newest rows first, but not always strictly, so every row is
+            # merged at the oldest time listed up to it, which keeps each file's own order
+            time = (
+                table[key_columns[0]]
+                .cast(pa.string())
+                .cast(pa.timestamp("ms", tz="UTC"))
+                .cast(pa.int64())
+            )
+            time = pc.fill_null(time, np.iinfo(np.int64).max).to_numpy()
+            times.append(np.minimum.accumulate(time)[new])
+            parts.append(table.filter(pa.array(new)))
+
+        # Merge the files newest first, rows with equal times in the order of the files
+        order = np.argsort(-np.concatenate(times), kind="stable")
+        return pa.concat_tables(parts).take(order)
+
+
+    # Function to hash the identifying columns of every row together with the number of earlier
+    # rows of the file with the same values, so repeated fills within one export stay distinct
+    def row_keys(self, table):
+
+        hashes = pd.util.hash_pandas_object(table.to_pandas(), index=False).to_numpy()
+        occurrences = (
+            pd.Series(hashes).groupby(hashes).cumcount().to_numpy().astype(np.uint64)
+        )
+        return hashes ^ (occurrences * np.uint64(0x9E3779B97F4A7C15))
+
+
+    # Function to hash the content of a file, remembered while its size and modification time stay
+    def file_digest(self, file_path):
+
+        stat = os.stat(file_path)
+        marker = (file_path, stat.st_size, stat.st_mtime_ns)
+        if marker not in self.file_digests:
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    digest.update(block)
+            self.file_digests[marker] = digest.hexdigest()
+        return self.file_digests[marker]
+
+
+    # Function to build the key of a cache entry from the code and the values the entry depends on
+    def cache_key(self, *parts):
+        return hashlib.sha256(
+            json.dumps([CACHE_VERSION, code_version(), *parts], default=str).encode()
+        ).hexdigest()
+
+
+    # Function to find an entry of the cache, marking it as recently used
+    def cache_entry(self, key):
+
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+
+        os.utime(path)
+        self.cache_used.add(key)
+        return path
+
+
+    # Function to add an entry to the cache, written by write_entry into a folder of its own
+    # The folder is renamed into place once complete, then the cache is brought back under its size
+    def save_cache_entry(self, key, write_entry):
+
+        path = os.path.join(self.cache_dir, key)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(temporary_path, exist_ok=True)
+        try:
+            write_entry(temporary_path)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(temporary_path, path)
+
+        # Results that Arrow cannot hold are not cached
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            return
+        finally:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+        self.cache_used.add(key)
+        self.evict_cache()
+
+
+    # Function to remove the least recently used entries until the cache fits its size
+    # Entries used by this instance are kept unless keep_used is off, another stage may still be
+    # reading them
+    def evict_cache(self, keep_used=True):
+
+        with self.cache_lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith(".tmp") or not os.path.isdir(path):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(root, file_name))
+                    for root, _, file_names in os.walk(path)
+                    for file_name in file_names
+                )
+                entries.append((os.path.getmtime(path), size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.cache_size:
+                    break
+                if not keep_used or name not in self.cache_used:
+                    shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+                    total -= size
+
+
+    # Function to save an Arrow table in the Arrow IPC file format, read back without parsing
+    def save_table(self, table, file_name):
+        with pa.OSFile(file_name, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+    # Function to load an Arrow table saved by save_table, memory mapping the file
+    def load_table(self, file_name):
+        return pa.ipc.open_file(pa.memory_map(file_name)).read_all()
+
+
+    # Function to build the Arrow types of the declared columns of an export file
+    # In compact mode repeated text is dictionary encoded, becoming categoricals
+    def column_types(self, file_name):
+
+        column_types = {
+            column: pa.type_for_alias(dtype) for column, dtype in SCHEMAS[file_name].items()
+        }
+        if self.compact:
+            for column in CATEGORICAL_COLUMNS.get(file_name, []):
+                column_types[column] = pa.dictionary(pa.int32(), pa.string())
+        return column_types
+
+
+    # Function to list the declared columns to read from an export file, the optional ones only
+    # when its header has them, so that the missing required ones still raise an error
+    def export_columns(self, file_name, file_path):
+        header = set(pd.read_csv(file_path, nrows=0).columns)
+        optional = OPTIONAL_COLUMNS.get(file_name, [])
+        return [
+            column
+            for column in SCHEMAS[file_name]
+            if column in header or column not in optional
+        ]
+
+
+    # Function to build the pyarrow options reading only the declared columns of an export file
+    def convert_options(self, file_name, file_path):
+        return pa_csv.ConvertOptions(
+            column_types=self.column_types(file_name),
+            include_columns=self.export_columns(file_name, file_path),
+            strings_can_be_null=True,
+        )
+
+
+    # Function to add the optional columns an export file left out as missing values, so that
+    # every table of a type has the declared columns in their declared order
+    def reindex_columns(self, table, file_name):
+        column_types = self.column_types(file_name)
+        return pa.table(
+            {
+                column: (
+                    table[column]
+                    if column in table.column_names
+                    else pa.chunked_array(
+                        [pa.nulls(table.num_rows, column_types[column])]
+                    )
+                )
+                for column in SCHEMAS[file_name]
+            }
+        )
+
+
+    # Function to parse an export file with the declared columns
+    def read_export(self, file_name, file_path):
+        return self.reindex_columns(
+            pa_csv.read_csv(
+                file_path, convert_options=self.convert_options(file_name, file_path)
+            ),
+            file_name,
+        )
+
+
+    # Function to find the byte ranges of the header and of chunks of rows of a CSV file
+    # without parsing it, the exports hold no quoted line breaks so every line break ends a row
+    def csv_chunk_ranges(self, file_path, chunksize, buffer_size=2**24):
+
+        starts = []
+        lines = 0
+        size = 0
+        with open(file_path, "rb") as f:
+            while True:
+                data = f.read(buffer_size)
+                if not data:
+                    break
+
+                # Chunk k starts after line break k * chunksize, the first one ends the header
+                breaks = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+                selected = breaks[(np.arange(len(breaks)) + lines) % chunksize == 0]
+                starts.extend((selected + size + 1).tolist())
+                lines += len(breaks)
+                size += len(data)
+
+        # A file without rows has no chunks
+        header_end = starts[0] if starts else size
+        starts = [start for start in starts if start < size]
+        return header_end, list(zip(starts, starts[1:] + [size]))
+
+
+    # Function to read the export files of a type in chunks of rows, from the last chunk to the
+    # first, each with its number
+    # Overlapping exports are merged first, which holds their rows in memory
+    def export_chunks(self, file_name, chunksize):
+
+        if len(self.export_files(file_name)) > 1:
+            table = self.read_table(file_name)
+            starts = range(0, table.num_rows, chunksize)
+            for number, start in reversed(list(enumerate(starts))):
+                yield number, table.slice(start, chunksize)
+            return
+
+        # A single export is read a chunk at a time, the header is parsed with every chunk
+        file_path = self.export_file(file_name)
+        header_end, ranges = self.csv_chunk_ranges(file_path, chunksize)
+        convert_options = self.convert_options(file_name, file_path)
+        with open(file_path, "rb") as f:
+            header = f.read(header_end)
+            for number, (start, end) in reversed(list(enumerate(ranges))):
+                f.seek(start)
+                yield number, self.reindex_columns(
+                    pa_csv.read_csv(
+                        io.BytesIO(header + f.read(end - start)),
+                        convert_options=convert_options,
+                    ),
+                    file_name,
+                )
+
+
+    # Function to parse the ISO-8601 export timestamps in one vectorized pass
+    def parse_timestamps(self, values, utc=False):
+        parsed = self.timestamp_array(values, utc).to_pandas()
+        parsed.index = values.index
+        return parsed
+
+
+    # Function to parse ISO-8601 export timestamps into Arrow timestamps in nanoseconds
+    # Columns of Arrow tables are used as they are
+    def timestamp_array(self, values, utc=False):
+
+        # Parse the strings with Arrow's fixed ISO-8601 parser, the exports are in UTC
+        text = (
+            values
+            if isinstance(values, pa.ChunkedArray)
+            else pa.array(values, type=pa.string())
+        )
+        timestamps = text.cast(pa.timestamp("ms", tz="UTC"))
+
+        # Truncate to the minute for Koinly unless the timezone is kept
+        if not utc:
+            timestamps = pc.floor_temporal(timestamps, unit="minute")
+
+        timestamps = timestamps.cast(pa.timestamp("ns", tz="UTC"))
+        return timestamps if utc else timestamps.cast(pa.timestamp("ns"))
+
+
+    # Function to count the decimals written in numbers written as strings, missing for missing values
+    def written_decimals(self, values):
+
+        # Columns of Arrow tables are used as they are
+        text = (
+            values
+            if isinstance(values, pa.ChunkedArray)
+            else pa.array(values, type=pa.string())
+        )
+        point = pc.find_substring(text, ".")
+        return pc.if_else(
+            pc.less(point, 0),
+            0,
+            pc.subtract(pc.subtract(pc.utf8_length(text), point), 1),
+        )
+
+
+    # Function to find the largest number of decimals among numbers written as strings
+    def count_decimals(self, values):
+        return pc.max(self.written_decimals(values)).as_py() or 0
+
+
+    # Function to build the decimals of every integer trade column from those of sizes and prices
+    def column_decimals(self, amount, price):
+        return {
+            "Amount": int(amount),
+            "Price": int(price),
+            "Fee Amount": USDC_DECIMALS,
+            "Total": int(amount) + int(price),
+            "Running Sum": int(amount),
+        }
+
+
+    # Function to set the decimals of every pair's integer trade columns from its trades' sizes and
+    # prices, at least those given for the pair, returning the decimals of each trade's sizes and prices
+    # Each pair is scaled by its own decimals, so a market priced with many decimals does not
+    # raise the scale of the totals of the others beyond 64-bit integers
+    def trade_decimals(self, decimals, pairs, sizes, prices):
+
+        # Number the pairs of the trades, trades without a pair are numbered -1
+        if not isinstance(pairs, pd.Series):
+            pairs = pairs.to_pandas()
+        codes, names = pd.factorize(pairs)
+
+        # Largest decimals written in the sizes and prices of each pair
+        found = (
+            pd.DataFrame(
+                {
+                    "Amount": pc.fill_null(self.written_decimals(sizes), 0).to_numpy(),
+                    "Price": pc.fill_null(self.written_decimals(prices), 0).to_numpy(),
+                }
+            )
+            .groupby(codes)
+            .max()
+        )
+
+        # Decimals of each pair, looked up by number below with those without a pair last
+        amounts = np.zeros(len(names) + 1, dtype=np.int64)
+        prices = np.zeros(len(names) + 1, dtype=np.int64)
+        for code, amount, price in found.itertuples():
+            pair = None if code < 0 else names[code]
+            given = (decimals or {}).get(pair, {})
+            self.decimals[pair] = self.column_decimals(
+                max(amount, given.get("Amount", 0)), max(price, given.get("Price", 0))
+            )
+            amounts[code] = self.decimals[pair]["Amount"]
+            prices[code] = self.decimals[pair]["Price"]
+
+        return {"Amount": amounts[codes], "Price": prices[codes]}
+
+
+    # Function to find the decimals of the integer trade columns of every row from its pair
+    # Rows without a pair use those of the trades without one, separator rows hold no values
+    def row_decimals(self, pairs):
+
+        # The decimals are copied first, the trades stage may set them while other stages write
+        decimals = self.decimals.copy()
+        if isinstance(pairs, (pa.Array, pa.ChunkedArray)):
+            pairs = pairs.to_pandas()
+        codes, names = pd.factorize(pairs)
+        table = pd.DataFrame(
+            [decimals[name] for name in names] + [decimals.get(None, {})],
+            columns=SCALED_COLUMNS,
+        )
+        table = table.fillna(0).astype(np.int64)
+        return {column: table[column].to_numpy()[codes] for column in SCALED_COLUMNS}
+
+
+    # Function to convert numbers written as strings into int64 values scaled by 10 ** decimals,
+    # the same decimals for every value or those of each value
+    def to_scaled(self, values, decimals):
+        return pd.Series(
+            self.nullable_integers(self.scaled_array(values, decimals)),
+            index=values.index,
+            name=values.name,
+        )
+
+
+    # Function to convert numbers written as strings into an Arrow array of scaled int64 values
+    # Columns of Arrow tables are used as they are
+    def scaled_array(self, values, decimals):
+
+        # Values that are not plain decimal numbers become missing, like numeric coercion
+        text = (
+            values
+            if isinstance(values, pa.ChunkedArray)
+            else pa.array(values, type=pa.string())
+        )
+        text = pc.if_else(
+            pc.match_substring_regex(text, r"^-?[0-9]+(\.[0-9]*)?$"), text, None
+        )
+
+        # Count the decimals written for each value
+        written = self.written_decimals(text)
+        if pc.any(pc.greater(written, decimals)).as_py():
+            raise ValueError("Values have more decimals than they are scaled by")
+
+        # Drop the decimal point and scale the digits up to the common number of decimals
+        digits = pc.replace_substring(text, ".", "").cast(pa.int64())
+        scale = pc.power(10, pc.subtract(decimals, written)).cast(pa.int64())
+        return pc.multiply_checked(digits, scale)
+
+
+    # Function to convert an Arrow array of int64 values into a pandas nullable integer array
+    def nullable_integers(self, values):
+        return pd.arrays.IntegerArray(
+            pc.fill_null(values, 0).to_numpy(),
+            values.is_null().to_numpy(zero_copy_only=False),
+        )
+
+
+    # Function to write int64 values scaled by 10 ** decimals as decimal strings,
+    # the same decimals for every value or those of each value
+    def format_scaled(self, values, decimals):
+
+        values = pd.Series(values, dtype="Int64")
+        missing = values.isna().to_numpy()
+        scaled = values.fillna(0).to_numpy(dtype=np.int64)
+        decimals = np.asarray(decimals, dtype=np.int64)
+
+        # Split each value into its whole part and its fraction, zero-padded by writing it
+        # after a leading one that is then dropped
+        whole, fraction = np.divmod(np.abs(scaled), 10**decimals)
+        fraction = pc.utf8_slice_codeunits(
+            pa.array(fraction + 10**decimals).cast(pa.string()), 1
+        )
+
+        # Keep at least one decimal, like the float values written before
+        fraction = pc.utf8_rtrim(fraction, characters="0")
+        fraction = pc.if_else(pc.equal(fraction, ""), "0", fraction)
+        whole = pc.binary_join_element_wise(
+            pc.if_else(pa.array(scaled < 0), "-", ""),
+            pa.array(whole).cast(pa.string()),
+            "",
+        )
+        text = pc.binary_join_element_wise(whole, fraction, ".")
+
+        # Missing values stay empty
+        text = text.to_numpy(zero_copy_only=False)
+        text[missing] = np.nan
+        return pd.Series(text, index=values.index, name=values.name)
+
+
+    # Function to write the integer trade columns of a DataFrame as decimal strings,
+    # each row with the decimals of its pair
+    def format_decimals(self, df):
+
+        # Only the formatted columns are replaced, the others are shared with the original
+        df = df.copy(deep=False)
+        columns = [
+            column
+            for column in SCALED_COLUMNS
+            if column in df.columns and pd.api.types.is_integer_dtype(df[column])
+        ]
+        if columns:
+            decimals = self.row_decimals(df["Pair"])
+            for column in columns:
+                df[column] = self.format_scaled(df[column], decimals[column])
+        return df
+
+
+    # Function to process a file using a specific processing function and save the output
+    @profiled
+    def process_file(self, file_name, process_func, output_file):
+
+        # Read the input CSV file, as the backend processes it
+        df = self.backend.read_input(file_name)
+
+        # Process the data using the provided function
+        df = process_func(df)
+
+        # Save the processed data to an output CSV file
+        self.save_output(df, output_file)
+
+
+    # Function to save a Koinly output file as CSV and, optionally, to the Parquet store
+    def save_output(self, df, output_file):
+
+        if self.store_dir is not None:
+            self.save_store(df, f"dYdX_{output_file}")
+
+        # Write the exact integer columns as decimal strings
+        if self.write_csv:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.write_csv_file(
+                df, os.path.join(self.output_dir, f"dYdX_{output_file}.csv")
+            )
+
+
+    # Function to write a DataFrame as CSV in chunks of rows, optionally with its index
+    # Only one chunk at a time is formatted, so large frames are streamed to the file
+    def write_csv_file(self, df, file_name, index_file=False):
+
+        chunk_rows = max(CSV_CHUNK_CELLS // max(len(df.columns), 1), 1)
+        line_ends = []
+        size = 0
+
+        with open(file_name, "wb") as f:
+            for start in range(0, max(len(df), 1), chunk_rows):
+                data = self.csv_bytes(
+                    self.format_decimals(df.iloc[start : start + chunk_rows]),
+                    header=start == 0,
+                )
+                f.write(data)
+
+                # Remember where the lines end for the index
+                if index_file:
+                    line_ends.append(
+                        np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+                        + size
+                        + 1
+                    )
+                size += len(data)
+
+        if index_file:
+            self.save_csv_index(df, np.concatenate(line_ends), size, file_name)
+
+
+    # Function to write a DataFrame as CSV bytes, with the Arrow writer when it is chosen and
+    # supports every column, otherwise with pandas
+    def csv_bytes(self, df, header=True):
+
+        if self.csv_writer == "arrow":
+            columns = [
+                self.csv_column(df.index),
+                *(self.csv_column(df.iloc[:, i]) for i in range(len(df.columns))),
+            ]
+            if all(column is not None for column in columns):
+
+                # Join the cells of every row and end each with a line break
+                lines = pc.binary_join_element_wise(*columns, ",")
+                lines = pc.binary_join_element_wise(lines, os.linesep, "")
+                # The lines have no missing values, so their characters are the bytes to write
+                data = b""
+                if len(lines):
+                    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32)[
+                        lines.offset : lines.offset + len(lines) + 1
+                    ]
+                    data = lines.buffers()[2][offsets[0] : offsets[-1]].to_pybytes()
+
+                # The header quotes names like the cells
+                if header:
+                    names = [df.index.name, *df.columns]
+                    names = pa.array(["" if name is None else str(name) for name in names])
+                    data = (
+                        ",".join(self.csv_quote(names).to_pylist()) + os.linesep
+                    ).encode() + data
+                return data
+
+        return df.to_csv(index=True, header=header).encode()
+
+
+    # Function to write a column as CSV cells the way pandas does, None when it cannot
+    def csv_column(self, values):
+
+        # Missing values are written as empty cells
+        dtype = values.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+            dtype = values.dtype
+
+        if pd.api.types.is_integer_dtype(dtype):
+            cells = pa.array(values, from_pandas=True).cast(pa.string())
+
+        # Naive dates whole to the second, written without the time if they are all midnight
+        elif pd.api.types.is_datetime64_dtype(dtype):
+            stamps = np.asarray(values, dtype="datetime64[ns]")
+            dated = ~np.isnat(stamps)
+            nanoseconds = stamps.view(np.int64)[dated]
+            if (nanoseconds % 10**9).any():
+                return None
+            dates_only = not (nanoseconds % (86400 * 10**9)).any()
+            cells = np.datetime_as_string(stamps, unit="D" if dates_only else "s")
+            cells = pc.replace_substring(pa.array(cells), "T", " ", max_replacements=1)
+            cells = pc.if_else(pa.array(dated), cells, None)
+
+        # Text, quoted only when it holds a delimiter, quote or line break
+        elif dtype == object:
+            try:
+                cells = pa.array(values, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                return None
+            if pa.types.is_null(cells.type):
+                cells = cells.cast(pa.string())
+            if not pa.types.is_string(cells.type):
+                return None
+            cells = self.csv_quote(cells)
+
+        # Other types, such as floats, keep the pandas formatting
+        else:
+            return None
+
+        return pc.fill_null(cells, "")
+
+
+    # Function to quote CSV cells holding a delimiter, quote or line break, doubling their quotes
+    def csv_quote(self, cells):
+        return pc.if_else(
+            pc.match_substring_regex(cells, '[,"\r\n]'),
+            pc.binary_join_element_wise(
+                '"', pc.replace_substring(cells, '"', '""'), '"', ""
+            ),
+            cells,
+        )
+
+
+    # Processing function for deposit auto swaps, run by the backend
+    @profiled
+    def process_deposit_swaps(self, df):
+        return self.backend.process_deposit_swaps(df)
+
+
+    # Processing function for transfers data, run by the backend
+    @profiled
+    def process_transfers(self, df):
+        return self.backend.process_transfers(df)
+
+
+    # Processing function for funding data, run by the backend
+    @profiled
+    def process_funding(self, df):
+        return self.backend.process_funding(df)
+
+
+    # Function to run the funding stage, with the whole export or in chunks of rows
+    def process_funding_stage(self, output_file="Funding"):
+        if self.funding_chunksize is None and not self.funding_by_market:
+            self.process_file("Funding", self.process_funding, output_file)
+        else:
+            self.process_funding_file(
+                "Funding",
+                output_file,
+                self.funding_chunksize or 100000,
+                self.funding_by_market,
+            )
+
+
+    # Function to process a funding file in fixed-size chunks, keeping a running total per day
+    @profiled
+    def process_funding_file(
+        self, file_name, output_file, chunksize=100000, by_market=False
+    ):
+
+        # Running totals per day and market, bounded by the number of days and markets
+        totals = None
+
+        # Read only the needed columns of the input CSV file, one chunk at a time
+        # Overlapping exports are merged first, which holds their rows in memory
+        file_paths = self.export_files(file_name) or [self.export_file(file_name)]
+        if len(file_paths) > 1:
+            table = self.read_table(file_name)
+            chunks = (
+                table.slice(start, chunksize).to_pandas()
+                for start in range(0, table.num_rows, chunksize)
+            )
+        else:
+            chunks = (
+                chunk.reindex(columns=list(SCHEMAS["Funding"]))
+                for chunk in pd.read_csv(
+                    file_paths[0],
+                    usecols=self.export_columns(file_name, file_paths[0]),
+                    dtype=SCHEMAS["Funding"],
+                    chunksize=chunksize,
+                )
+            )
+
+        for chunk in chunks:
+
+            # Convert 'effectiveAt' column to datetime format
+            chunk["effectiveAt"] = self.parse_timestamps(
+                chunk["effectiveAt"], utc=True
+            ).dt.normalize()
+
+            # Convert 'payment' column to integer USDC amounts, handling errors
+            chunk["payment"] = self.to_scaled(chunk["payment"], USDC_DECIMALS)
+
+            # Aggregate the chunk by date and market and add it to the running totals
+            # Payments without a market count towards their day, as in process_funding
+            chunk_totals = chunk.groupby(["effectiveAt", "market"], dropna=False)[
+                "payment"
+            ].sum()
+            totals = (
+                chunk_totals
+                if totals is None
+                else pd.concat([totals, chunk_totals])
+                .groupby(level=[0, 1], dropna=False)
+                .sum()
+            )
+
+        # Start from an empty aggregate if the file has no rows
+        if totals is None:
+            totals = pd.Series(
+                dtype="Int64",
+                index=pd.MultiIndex.from_arrays(
+                    [pd.DatetimeIndex([], tz="UTC"), []],
+                    names=["effectiveAt", "market"],
+                ),
+            )
+        totals = totals[totals.index.get_level_values("effectiveAt").notnull()].sort_index()
+
+        # Sum the market totals into day totals and save them in the Koinly format
+        df = totals.groupby(level="effectiveAt").sum().reset_index()
+        df = self.format_funding(df)
+        self.save_output(df, output_file)
+
+        # Optionally save the funding breakdown per market
+        if by_market:
+            market_df = totals.reset_index()
+            market_df.columns = ["Koinly Date", "Market", "Amount"]
+            market_df["Amount"] = self.format_scaled(market_df["Amount"], USDC_DECIMALS)
+            market_df.set_index("Koinly Date", inplace=True)
+            self.save_output(market_df, f"{output_file}_By_Market")
+            return df, market_df
+
+        return df
+
+
+    # Function to format daily funding totals for Koinly
+    def format_funding(self, df):
+
+        df.columns = ["Koinly Date", "Amount"]
+
+        # Assign labels based on 'Amount' values
+        df["Label"] = np.where(df["Amount"] < 0, "Margin Fee", "Lending Interest")
+
+        # Write the exact integer amounts as decimal strings
+        df["Amount"] = self.format_scaled(df["Amount"], USDC_DECIMALS)
+
+        # Assign fixed currency and description
+        df["Currency"] = "USDC"
+        df["Description"] = "Funding"
+
+        # Set 'Koinly Date' as index
+        df.set_index("Koinly Date", inplace=True)
+        return df
+
+
+    # Processing function for trade data, run by the backend
+    # The decimals of each pair's sizes and prices are found from its trades, at least those given
+    # for the pair
+    @profiled
+    def process_trades(self, df, decimals=None):
+        return self.backend.process_trades(df, decimals)
+
+
+    # Function to generate the loan summary of one side from blocks of trade data
+    def generate_loan_summary(self, df, side):
+        buy_side_df, sell_side_df = self.generate_loan_summaries(df)
+        return buy_side_df if side == "Buy" else sell_side_df
+
+
+    # Function to generate the buy-side and sell-side loan summaries, run by the backend
+    # A block is a buy-side loan of USDC when its first trade is a buy, otherwise a sell-side loan of the crypto
+    @profiled
+    def generate_loan_summaries(self, df):
+        return self.backend.generate_loan_summaries(df)
+
+
+    # Function to split chronologically ordered trades of one pair into position blocks,
+    # run by the backend
+    # The running sum and block number can be carried over from previously processed trades
+    def segment_blocks(self, df, running_sum=0, block=0):
+        return self.backend.segment_blocks(df, running_sum, block)
+
+
+    # Function to calculate an exact integer running sum that continues from a starting value
+    def running_sums(self, values, start=0):
+        return np.cumsum(values.to_numpy(dtype=np.int64)) + start
+
+
+    # Function to split one pair's trades into blocks and generate its loan summaries
+    @profiled
+    def process_pair(self, df):
+
+        # Reverse the order of the data for the pair, a view, and split it into blocks
+        trade_df = self.segment_blocks(df[::-1])
+
+        # Generate loan summaries for buy and sell sides
+        buy_side_df, sell_side_df = self.generate_loan_summaries(trade_df)
+
+        return trade_df, buy_side_df, sell_side_df
+
+
+    # Function to process the pairs one after another, as a generator of their results
+    def process_pairs(self, pairs):
+        for pair in pairs:
+            with self.profile_pair(pair):
+                result = self.process_pair(self.trade_data[pair])
+            yield result
+
+
+    # Function to process trade data, optionally spreading the pairs over a pool of worker processes
+    @profiled
+    def process_granular_data(self, workers=None):
+
+        pairs = list(self.trade_data)
+
+        # Load the results of pairs whose trades were processed before from the cache
+        key = None
+        if self.cache_dir is not None:
+            key = self.cache_key(
+                "pairs",
+                self.compact,
+                self.decimals,
+                [(pair, self.frame_digest(self.trade_data[pair])) for pair in pairs],
+            )
+            entry = self.cache_entry(key)
+            if entry is not None:
+                self.load_pair_results(entry, pairs)
+                return
+
+        # Process the pairs in worker processes, results come back in the order of the pairs
+        if workers is not None and workers > 1 and len(pairs) > 1:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=process_context()
+            ) as executor:
+                results = list(
+                    executor.map(
+                        process_pair_data,
+                        [self.trade_data[pair] for pair in pairs],
+                        repeat(self.decimals),
+                        repeat(self.profiler is not None),
+                        repeat(self.backend_name),
+                    )
+                )
+
+            # Add the stages recorded by the workers to the profile of each pair
+            if self.profiler is not None:
+                for pair, (_, records) in zip(pairs, results):
+                    self.profiler.add_records(records, pair)
+            results = [result for result, _ in results]
+
+        # Otherwise process them one after another
+        else:
+            results = self.process_pairs(pairs)
+
+        # Update the trade data and loan summaries for each pair
+        for pair, (trade_df, buy_side_df, sell_side_df) in zip(pairs, results):
+            self.trade_data[pair] = trade_df
+            self.buy_side_data[pair] = buy_side_df
+            self.sell_side_data[pair] = sell_side_df
+
+        if key is not None:
+            self.save_cache_entry(key, lambda entry: self.save_pair_results(entry, pairs))
+
+
+    # Function to hash the content of a DataFrame, with its index and column names
+    def frame_digest(self, df):
+        digest = hashlib.sha256(json.dumps(list(map(str, df.columns))).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        return digest.hexdigest()
+
+
+    # Function to save the trade data and loan summaries of the pairs in a cache entry,
+    # one Arrow file per pair and type with the pandas types kept in its metadata
+    def save_pair_results(self, entry, pairs):
+        for index, pair in enumerate(pairs):
+            for data_type, data_dict in [
+                ("trade", self.trade_data),
+                ("buy_side", self.buy_side_data),
+                ("sell_side", self.sell_side_data),
+            ]:
+                self.save_table(
+                    pa.Table.from_pandas(data_dict[pair]),
+                    os.path.join(entry, f"{data_type}_{index}.arrow"),
+                )
+
+
+    # Function to load the trade data and loan summaries of the pairs from a cache entry
+    def load_pair_results(self, entry, pairs):
+        for index, pair in enumerate(pairs):
+            for data_type, data_dict in [
+                ("trade", self.trade_data),
+                ("buy_side", self.buy_side_data),
+                ("sell_side", self.sell_side_data),
+            ]:
+                data_dict[pair] = self.load_table(
+                    os.path.join(entry, f"{data_type}_{index}.arrow")
+                ).to_pandas()
+
+
+    # Function to format loan data
+    @profiled
+    def format_loan_data(self, df):
+
+        # Calculate start dates by subtracting 1 minute from "Start_Koinly_Date"
+        start_dates = (df["Start_Koinly_Date"] - timedelta(minutes=1)).to_numpy()
+
+        # Calculate last dates by adding 1 minute to "Last_Koinly_Date"
+        last_dates = (df["Last_Koinly_Date"] + timedelta(minutes=1)).to_numpy()
+
+        # Extract sides and values from DataFrame
+        sides = df["Side"].to_numpy()
+        values = df["Amount"].to_numpy()
+
+        # Define labels for loan and repayment, as categoricals in compact mode
+        label_loan = "Margin Loan"
+        label_repayment = "Margin Repayment"
+        if self.compact:
+            labels = pd.CategoricalDtype([label_loan, label_repayment])
+            label_loan = pd.Categorical.from_codes(np.zeros(len(df), dtype=int), dtype=labels)
+            label_repayment = pd.Categorical.from_codes(np.ones(len(df), dtype=int), dtype=labels)
+
+        # Create dictionary for receiving loan
+        receive_loan = {
+            "Date": start_dates,
+            "Received Amount": values,
+            "Received Currency": sides,
+            "Sent Amount": "",
+            "Sent Currency": "",
+            "Label": label_loan,
+        }
+
+        # Create dictionary for loan repayment
+        return_loan = {
+            "Date": last_dates,
+            "Received Amount": "",
+            "Received Currency": "",
+            "Sent Amount": values,
+            "Sent Currency": sides,
+            "Label": label_repayment,
+        }
+
+        # Create DataFrames from loan receive and repayment dictionaries
+        receive_df = pd.DataFrame(receive_loan)
+        return_df = pd.DataFrame(return_loan)
+
+        # Concatenate DataFrames for loan repayment and receive, so a block's repayment
+        # comes before the next block's loan in the same minute
+        formatted_df = pd.concat([return_df, receive_df])
+
+        # Both are in date order already, so the stable sort merges the two in linear time
+        formatted_df = formatted_df.sort_values(by="Date", kind="stable")
+
+        # Set "Date" column as index
+        formatted_df.set_index("Date", inplace=True)
+        return formatted_df
+
+
+    # Function to process loan data
+    def process_loan_data(self, data):
+
+        # Iterate over each symbol and its corresponding DataFrame in the provided data
+        for symbol, df in data.items():
+
+            # Process the loan data DataFrame using the format_loan_data function
+            with self.profile_pair(symbol):
+                processed_df = self.format_loan_data(df)
+
+            # Replace the original DataFrame in the data dictionary with the processed DataFrame
+            data[symbol] = processed_df
+
+
+    # Function to process buy-side loans
+    @profiled
+    def process_buy_side_loans(self):
+
+        # Process loan data for buy-side loans using the process_loan_data function
+        self.process_loan_data(self.buy_side_data)
+
+
+    # Function to process sell-side loans
+    @profiled
+    def process_sell_side_loans(self):
+
+        # Process loan data for sell-side loans using the process_loan_data function
+        self.process_loan_data(self.sell_side_data)
+
+
+    # Function to merge loan data
+    # Each pair's loans are in date order, so they are merged a chunk of rows at a time and
+    # written as they are merged, without sorting the merged DataFrame
+    # The merged loans of both sides are returned, unless return_frames is off, which keeps only
+    # a chunk of rows in memory
+    @profiled
+    def merge_loans(self, return_frames=True):
+
+        # Merge and save both sides at the same time
+        with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.save_merged_loans,
+                    self.loan_sources(self.buy_side_data, self.buy_side_files),
+                    "USDC_Loans",
+                    return_frames,
+                ),
+                executor.submit(
+                    self.save_merged_loans,
+                    self.loan_sources(self.sell_side_data, self.sell_side_files),
+                    "Crypto_Loans",
+                    return_frames,
+                ),
+            ]
+            merged_buy_df, merged_sell_df = [future.result() for future in futures]
+
+        # Return the merged DataFrames for buy and sell side loans
+        if return_frames:
+            return merged_buy_df, merged_sell_df
+
+
+    # Function to read the loans of every pair in chunks of rows, from memory or from their files
+    def loan_sources(self, data_dict, files):
+        sources = [
+            self.frame_chunks(df, LOAN_MERGE_ROWS)
+            for df in data_dict.values()
+            if not df.empty
+        ]
+        for file_name in files.values():
+            sources.append(
+                pd.read_csv(
+                    file_name,
+                    index_col="Date",
+                    dtype=str,
+                    keep_default_na=False,
+                    chunksize=LOAN_MERGE_ROWS,
+                )
+            )
+        return sources
+
+
+    # Function to yield a DataFrame in chunks of rows
+    def frame_chunks(self, df, chunk_rows):
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start : start + chunk_rows]
+
+
+    # Function to merge date-ordered chunks of loans from several pairs into date-ordered chunks
+    # Rows of the same date keep the order of their pairs, as a stable sort of all of them would
+    def merge_loan_chunks(self, sources):
+
+        # Unmerged rows of every pair, with their dates as an array to compare them quickly
+        pending = [None] * len(sources)
+        dates = [None] * len(sources)
+        last_read = [None] * len(sources)
+        cutoff = None
+
+        while True:
+
+            # Read on from every pair whose unmerged rows all have the last date merged up to
+            for i, source in enumerate(sources):
+                while source is not None and (pending[i] is None or dates[i][-1] == cutoff):
+                    chunk = next(source, None)
+                    if chunk is None:
+                        sources[i] = source = None
+                    elif not chunk.empty:
+
+                        # Loans out of date order would be merged out of order without an error
+                        chunk_dates = chunk.index.to_numpy()
+                        if (chunk_dates[1:] < chunk_dates[:-1]).any() or (
+                            last_read[i] is not None and chunk_dates[0] < last_read[i]
+                        ):
+                            raise ValueError(
+                                "The loans of a pair are not in date order, process the "
+                                "pair again from its first trade to merge them"
+                            )
+                        last_read[i] = chunk_dates[-1]
+
+                        pending[i] = (
+                            chunk if pending[i] is None else pd.concat([pending[i], chunk])
+                        )
+                        dates[i] = pending[i].index.to_numpy()
+
+            # Rows before the earliest last date of the pairs still being read are complete
+            last_dates = [dates[i][-1] for i, source in enumerate(sources) if source is not None]
+            cutoff = min(last_dates) if last_dates else None
+
+            parts = []
+            for i, df in enumerate(pending):
+                if df is None:
+                    continue
+                end = len(df) if cutoff is None else np.searchsorted(dates[i], cutoff, side="left")
+                if end == 0:
+                    continue
+                parts.append(df.iloc[:end])
+                pending[i] = df.iloc[end:] if end < len(df) else None
+                dates[i] = dates[i][end:]
+
+            if parts:
+                merged = pd.concat(parts)
+                yield merged.iloc[np.argsort(merged.index.to_numpy(), kind="stable")]
+
+            if cutoff is None:
+                return
+
+
+    # Function to save the merged loans of one side as they are merged, returning them when kept
+    # The rows are written in the chunks write_csv_file would use, so the bytes are the same
+    def save_merged_loans(self, sources, output_file, keep=False):
+
+        chunk_rows = CSV_CHUNK_CELLS // len(LOAN_COLUMNS)
+        file_name = os.path.join(self.output_dir, f"dYdX_{output_file}.csv")
+        empty_df = pd.DataFrame(columns=LOAN_COLUMNS, index=pd.Index([], name="Date"))
+        stored = []
+        buffered = []
+        rows = 0
+        header = True
+
+        if self.write_csv:
+            os.makedirs(self.output_dir, exist_ok=True)
+        with (open(file_name, "wb") if self.write_csv else contextlib.nullcontext()) as f:
+            for df in chain(self.merge_loan_chunks(sources), [None]):
+
+                # Keep the rows for the Parquet store, which is written in one go, or to return them
+                if df is not None and (keep or self.store_dir is not None):
+                    stored.append(df)
+                if not self.write_csv:
+                    continue
+
+                # Collect the merged rows until there is a full chunk to write
+                if df is not None:
+                    buffered.append(df)
+                    rows += len(df)
+                    if rows < chunk_rows:
+                        continue
+
+                # Write every full chunk, and what is left at the end
+                buffer = pd.concat(buffered) if buffered else empty_df
+                end = len(buffer) if df is None else len(buffer) - len(buffer) % chunk_rows
+                for start in range(0, max(end, 1 if header else 0), chunk_rows):
+                    f.write(
+                        self.csv_bytes(
+                            self.format_decimals(buffer.iloc[start : start + chunk_rows]),
+                            header=header,
+                        )
+                    )
+                    header = False
+                buffered = [buffer.iloc[end:]]
+                rows = len(buffered[0])
+
+        merged_df = pd.concat(stored) if stored else empty_df
+        if self.store_dir is not None:
+            self.save_store(merged_df, f"dYdX_{output_file}")
+        if keep:
+            return merged_df
+
+
+    # Instance method to access data DataFrame by type
+    def access_data(self, data_type, pair=None):
+
+        # Determine the data dictionary based on the specified data type
+        if data_type == "trade":
+            data_dict = self.trade_data
+        elif data_type == "buy_side":
+            data_dict = self.buy_side_data
+        elif data_type == "sell_side":
+            data_dict = self.sell_side_data
+        else:
+
+            # Raise a ValueError if an invalid data type is provided
+            raise ValueError(
+                "Invalid data type. Choose from 'trade', 'buy_side', or 'sell_side'."
+            )
+
+        # In lazy mode the pairs are processed when they are asked for
+        if self.lazy:
+            position = ["trade", "buy_side", "sell_side"].index(data_type)
+            if pair:
+                result = self.process_lazy_pair(pair)
+                return None if result is None else result[position]
+            return {
+                pair: self.process_lazy_pair(pair)[position]
+                for pair in self.lazy_pairs()
+            }
+
+        # If pair is specified, return the DataFrame corresponding to that pair
+        if pair:
+            return data_dict.get(pair)
+
+        # Otherwise, return the entire data dictionary
+        return data_dict
+
+
+    # Function to parse the trades export once for lazy access
+    def load_lazy_trades(self):
+        if self.lazy_trades is None:
+            self.lazy_trades = self.read_table("Trades")
+        return self.lazy_trades
+
+
+    # Function to list the pairs of the trades export, in the order they first appear
+    def lazy_pairs(self):
+        table = self.load_lazy_trades()
+        markets = pc.unique(table["market"].cast(pa.string()))
+        return [f"{market}C" for market in markets.to_pylist() if market is not None]
+
+
+    # Function to process the trades of a single pair, returning its trade data and formatted loans
+    # The results of the most recently used pairs are kept, the least recently used is dropped first
+    def process_lazy_pair(self, pair):
+
+        if pair in self.pair_cache:
+            self.pair_cache.move_to_end(pair)
+            return self.pair_cache[pair]
+
+        # Select the pair's trades from the parsed export, pairs are the markets with a "C" added
+        # Its decimals are those of its own trades, as in a full run
+        table = self.load_lazy_trades()
+        market = table["market"].cast(pa.string())
+        table = table.filter(pc.equal(market, pair[:-1]))
+        if table.num_rows == 0:
+            return None
+
+        # Process the trades, blocks and loans of the pair alone
+        with self.profile_pair(pair):
+            self.process_trades(self.backend.from_table(table))
+            trade_df, buy_side_df, sell_side_df = self.process_pair(
+                self.trade_data.pop(pair)
+            )
+            result = (
+                trade_df,
+                self.format_loan_data(buy_side_df),
+                self.format_loan_data(sell_side_df),
+            )
+
+        self.pair_cache[pair] = result
+        while len(self.pair_cache) > self.pair_cache_size:
+            self.pair_cache.popitem(last=False)
+
+        return result
+
+
+    # Instance method to save all data DataFrames into a folder
+    @profiled
+    def save_data(self, data_dict, directory):
+
+        # Save the pairs to the Parquet store as one dataset named after the folder
+        if self.store_dir is not None:
+            self.save_store(data_dict, os.path.basename(os.path.normpath(directory)))
+
+        if self.write_csv:
+            self.save_csv_data(data_dict, directory)
+
+
+    # Function to save every pair's DataFrame as a CSV file in a folder
+    def save_csv_data(self, data_dict, directory):
+
+        # Create the directory if it does not exist
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Save each non-empty pair's DataFrame to a CSV file in the directory, with its index,
+        # several pairs at a time
+        with ThreadPoolExecutor(max_workers=self.write_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.write_csv_file,
+                    df,
+                    os.path.join(directory, f"{pair}.csv"),
+                    index_file=True,
+                )
+                for pair, df in data_dict.items()
+                if not df.empty
+            ]
+            for future in futures:
+                future.result()
+
+
+    # Function to save the index of a per-pair CSV file next to it
+    # Each segment, a block of trade data or a run of rows otherwise, has its rows, bytes and dates,
+    # so a date range can be read from the file without parsing all of it
+    # The line ends are the byte offsets after each line break, the first line is the header
+    def save_csv_index(self, df, line_ends, size, file_name):
+
+        # Segments start at each new block, or every INDEX_SEGMENT_ROWS rows
+        if "Block" in df.columns:
+            blocks = df["Block"].to_numpy()
+            starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+        else:
+            blocks = None
+            starts = np.arange(0, len(df), INDEX_SEGMENT_ROWS)
+        ends = np.r_[starts[1:], len(df)]
+
+        # First and last date of each segment, rows without a date are the separators
+        dates = pd.to_datetime(
+            pd.Series(
+                (
+                    df["Koinly Date"] if "Koinly Date" in df.columns else df.index
+                ).to_numpy()
+            ),
+            errors="coerce",
+        )
+        grouped = dates.groupby(np.repeat(np.arange(len(starts)), ends - starts))
+        first_dates, last_dates = [
+            values.dt.strftime("%Y-%m-%d %H:%M:%S")
+            .astype(object)
+            .where(values.notnull(), None)
+            .tolist()
+            for values in [grouped.min(), grouped.max()]
+        ]
+
+        # Each segment ends where the next one starts, the last one at the end of the file, the
+        # size and modification time tell whether the file changed since
+        index = {
+            "size": size,
+            "mtime_ns": os.stat(file_name).st_mtime_ns,
+            "rows": len(df),
+            "header_end": int(line_ends[0]),
+            "blank_rows": int(dates.isnull().sum()),
+            "segments": {
+                "block": None if blocks is None else blocks[starts].tolist(),
+                "row_start": starts.tolist(),
+                "byte_start": line_ends[starts].tolist(),
+                "start_date": first_dates,
+                "end_date": last_dates,
+            },
+        }
+        with open(f"{file_name}{INDEX_SUFFIX}", "w") as f:
+            f.write(json.dumps(index))
+
+
+    # Function to save a DataFrame, or a dictionary of pair DataFrames, as a Parquet dataset
+    # The dataset is partitioned by pair and year so that reads only open the files they need
+    def save_store(self, data, dataset):
+        # The dataset module is only imported when the store is used
+        import pyarrow.dataset as ds
+
+        per_pair = isinstance(data, dict)
+        frames = data if per_pair else {None: data}
+
+        # Keep the index as a column and number the rows to restore their order when read
+        parts = []
+        for pair, df in frames.items():
+            if df.empty:
+                continue
+            index_name = df.index.name
+            df = df.reset_index()
+            df["Row"] = np.arange(len(df))
+            if per_pair:
+                df["pair"] = pair
+            elif "Pair" in df.columns:
+                df["pair"] = df["Pair"]
+            parts.append(df)
+
+        # Replace the previous version of the dataset
+        path = os.path.join(self.store_dir, dataset)
+        shutil.rmtree(path, ignore_errors=True)
+        if not parts:
+            return
+        df = pd.concat(parts, ignore_index=True)
+
+        # Partition by calendar year, separator rows stay with the trade before them
+        date_column = next(
+            column for column in ["Koinly Date", "Date"] if column in df.columns
+        )
+        dates = df[date_column]
+        if not pd.api.types.is_datetime64_any_dtype(dates):
+            dates = pd.to_datetime(dates, format="ISO8601", errors="coerce")
+        df["year"] = dates.dt.year.ffill().bfill().fillna(0).astype(np.int32)
+
+        # Record how to rebuild the DataFrames and the decimals of each pair's integer columns,
+        # as a list as trades without a pair have decimals too
+        columns = [
+            column
+            for column in SCALED_COLUMNS
+            if column in df.columns and pd.api.types.is_integer_dtype(df[column])
+        ]
+        metadata = {
+            "index": index_name,
+            "date": date_column,
+            "per_pair": per_pair,
+            "decimals": [
+                [pair, {column: decimals[column] for column in columns}]
+                for pair, decimals in self.decimals.copy().items()
+            ]
+            if columns
+            else [],
+        }
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {**table.schema.metadata, b"dydx": json.dumps(metadata)}
+        )
+
+        ds.write_dataset(
+            table,
+            path,
+            format="parquet",
+            partitioning=["pair", "year"] if "pair" in df.columns else ["year"],
+            partitioning_flavor="hive",
+        )
+
+
+    # Function to read a dataset of the Parquet store, with only the requested pairs, dates and columns
+    # Per-pair datasets are returned as a dictionary of pair DataFrames
+    def read_store(
+        self, dataset, start_date=None, end_date=None, pairs=None, columns=None, years=False
+    ):
+        import pyarrow.dataset as ds
+
+        store = ds.dataset(
+            os.path.join(self.store_dir, dataset), format="parquet", partitioning="hive"
+        )
+        metadata = json.loads(store.schema.metadata[b"dydx"])
+        for pair, decimals in metadata["decimals"]:
+            self.decimals[pair] = {**self.decimals.get(pair, {}), **decimals}
+        index_column = metadata["index"] or "index"
+        date_column = metadata["date"]
+        date_type = store.schema.field(date_column).type
+
+        # Only read the requested pairs
+        condition = ds.scalar(True)
+        if pairs is not None and "pair" in store.schema.names:
+            condition &= ds.field("pair").isin(pairs)
+
+        # Skip the years outside the date range, and the rows too when the dates are typed
+        # Rows without a date are the separators between blocks and are always kept
+        if start_date is not None:
+            start = pd.Timestamp(start_date).normalize()
+            condition &= ds.field("year") >= start.year
+            if pa.types.is_timestamp(date_type):
+                start = start.tz_localize(date_type.tz) if date_type.tz else start
+                condition &= ds.field(date_column).is_null() | (
+                    ds.field(date_column) >= pa.scalar(start, type=date_type)
+                )
+        if end_date is not None:
+            end = pd.Timestamp(end_date).normalize() + timedelta(days=1)
+            condition &= ds.field("year") <= end.year
+            if pa.types.is_timestamp(date_type):
+                end = end.tz_localize(date_type.tz) if date_type.tz else end
+                condition &= ds.field(date_column).is_null() | (
+                    ds.field(date_column) < pa.scalar(end, type=date_type)
+                )
+
+        # Read only the requested columns, with what is needed to rebuild the DataFrames and
+        # the pairs whose decimals the integer columns are scaled by
+        if columns is not None:
+            columns = list(
+                dict.fromkeys(
+                    [index_column, date_column, *columns, "Row"]
+                    + (["Pair"] if "Pair" in store.schema.names else [])
+                    + (["pair"] if "pair" in store.schema.names else [])
+                    + (["year"] if years else [])
+                )
+            )
+        df = store.to_table(columns=columns, filter=condition).to_pandas()
+
+        # Restore the original order and index
+        df = df.sort_values(
+            ["pair", "Row"] if metadata["per_pair"] else ["Row"], kind="stable"
+        )
+        # The year partition of each row is kept when asked, to split one read by date ranges
+        df = df.drop(columns=["Row"] if years else ["Row", "year"], errors="ignore")
+        df = df.set_index(index_column)
+        df.index.name = metadata["index"]
+
+        if metadata["per_pair"]:
+            return {
+                pair: pair_df.drop(columns="pair")
+                for pair, pair_df in df.groupby("pair", sort=False)
+            }
+        return df.drop(columns="pair", errors="ignore")
+
+
+    # Function to export a dataset of the Parquet store as CSV, e.g. to upload to Koinly
+    def export_store(
+        self, dataset, output_path, start_date=None, end_date=None, pairs=None
+    ):
+
+        data = self.read_store(dataset, start_date, end_date, pairs)
+
+        # Per-pair datasets become a folder with one file per pair
+        if isinstance(data, dict):
+            self.save_csv_data(data, output_path)
+        else:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            self.write_csv_file(data, output_path)
+
+        return data
+
+
+    # Function to load the checkpoint of a pair, or an empty position if it has none
+    def load_checkpoint(self, checkpoint_dir, pair):
+
+        # Construct the checkpoint file name based on the pair and directory
+        file_name = os.path.join(checkpoint_dir, f"{pair}.json")
+
+        # Start from an empty position if the pair has not been processed before
+        if not os.path.exists(file_name):
+            return self.empty_checkpoint()
+
+        with open(file_name) as f:
+            return json.load(f)
+
+
+    # Function to create the state of a pair without processed trades
+    def empty_checkpoint(self):
+        return {
+            "last_timestamp": None,  # Last processed trade timestamp
+            "last_timestamp_count": 0,  # Processed trades sharing that timestamp
+            "rows": 0,  # Rows written to the trade data file
+            "decimals": {},  # Decimals of the scaled integers below
+            "running_sum": 0,  # Running sum of "Amount"
+            "block": 0,  # Number of the open block
+            "open_block": None,  # Partial loan aggregates of the open block
+            "buy_side_offset": 0,  # Size of the buy-side file before the loans that may move
+            "sell_side_offset": 0,  # Size of the sell-side file before the loans that may move
+            "buy_side_tail": [],  # Loan summaries of the blocks with buy-side rows after the offset
+            "sell_side_tail": [],  # Loan summaries of the blocks with sell-side rows after the offset
+        }
+
+
+    # Function to bring the scaled integers of a pair's checkpoint to the pair's current decimals
+    def rescale_checkpoint(self, pair, state):
+
+        # Powers of ten between the saved and the current decimals
+        pair_decimals = self.decimals[pair]
+        factors = {
+            column: 10 ** (pair_decimals[column] - decimals)
+            for column, decimals in state["decimals"].items()
+        }
+        state["decimals"] = {
+            column: pair_decimals[column] for column in ["Amount", "Total"]
+        }
+        if not factors:
+            return state
+
+        state["running_sum"] *= factors["Amount"]
+
+        # Rescale the running sums and peak of the open block
+        aggregates = state["open_block"]
+        if aggregates is not None:
+            aggregates["running_total"] *= factors["Total"]
+            aggregates["running_amount"] *= factors["Amount"]
+            aggregates["peak"] *= factors[
+                "Total" if aggregates["side"] == "Buy" else "Amount"
+            ]
+
+        return state
+
+
+    # Function to raise the scale of a pair's integer trade columns to at least the given decimals
+    def raise_decimals(self, pair, decimals):
+
+        for column, target in decimals.items():
+            current = self.decimals[pair][column]
+            if target > current:
+
+                # Multiply the pair's column by the missing power of ten
+                df = self.trade_data[pair]
+                self.trade_data[pair] = df.assign(
+                    **{column: df[column] * 10 ** (target - current)}
+                )
+                self.decimals[pair] = {**self.decimals[pair], column: target}
+
+        # The running sums are sums of the amounts
+        self.decimals[pair] = {
+            **self.decimals[pair],
+            "Running Sum": self.decimals[pair]["Amount"],
+        }
+
+
+    # Function to save the checkpoint of a pair
+    def save_checkpoint(self, checkpoint_dir, pair, state):
+
+        # Create the directory if it does not exist
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # Write to a temporary file first so an interrupted run never leaves a partial checkpoint
+        file_name = os.path.join(checkpoint_dir, f"{pair}.json")
+        with open(f"{file_name}.tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{file_name}.tmp", file_name)
+
+
+    # Function to continue the loan aggregates of a block with its next trades
+    def update_block_aggregates(self, aggregates, df):
+
+        # Separator rows hold no trade
+        df = df[df["Koinly Date"].notnull()]
+        if df.empty:
+            return aggregates
+
+        # A new block takes its side and pair from its first trade
+        if aggregates is None:
+            aggregates = {
+                "side": df["Side"].iloc[0],
+                "pair": df["Pair"].iloc[0],
+                "start": str(df["Koinly Date"].iloc[0]),
+                "running_total": 0,
+                "running_amount": 0,
+                "peak": None,
+            }
+
+        # Continue the running sums of the "Total" and "Amount" columns
+        totals = self.running_sums(df["Total"], aggregates["running_total"])
+        amounts = self.running_sums(df["Amount"], aggregates["running_amount"])
+
+        # Track the maximum running total of buy blocks or the minimum running amount of sell blocks
+        if aggregates["side"] == "Buy":
+            peak = totals.max()
+            if aggregates["peak"] is not None:
+                peak = max(peak, aggregates["peak"])
+        else:
+            peak = amounts.min()
+            if aggregates["peak"] is not None:
+                peak = min(peak, aggregates["peak"])
+
+        return {
+            **aggregates,
+            "last": str(df["Koinly Date"].iloc[-1]),
+            "running_total": int(totals[-1]),
+            "running_amount": int(amounts[-1]),
+            "peak": int(peak),
+        }
+
+
+    # Function to generate the loan summary of a single block from its aggregates
+    def block_loan_summary(self, block, aggregates):
+
+        return pd.DataFrame(
+            {
+                "Block": [block],
+                "Start_Koinly_Date": [pd.Timestamp(aggregates["start"])],
+                "Last_Koinly_Date": [pd.Timestamp(aggregates["last"])],
+                "Side": [
+                    "USDC"
+                    if aggregates["side"] == "Buy"
+                    else aggregates["pair"][:-5]
+                ],
+                "Amount": self.format_scaled(
+                    [abs(aggregates["peak"])],
+                    self.decimals[aggregates["pair"]][
+                        "Total" if aggregates["side"] == "Buy" else "Amount"
+                    ],
+                ),
+            }
+        )
+
+
+    # Function to rebuild the loan summaries saved in a checkpoint
+    def loan_tail(self, records):
+        return pd.DataFrame(
+            {
+                "Block": [record["Block"] for record in records],
+                "Start_Koinly_Date": pd.to_datetime(
+                    [record["Start_Koinly_Date"] for record in records]
+                ),
+                "Last_Koinly_Date": pd.to_datetime(
+                    [record["Last_Koinly_Date"] for record in records]
+                ),
+                "Side": [record["Side"] for record in records],
+                "Amount": [record["Amount"] for record in records],
+            }
+        )
+
+
+    # Function to turn loan summaries into records that can be saved in a checkpoint
+    def loan_tail_records(self, df):
+        return [
+            {
+                "Block": int(block),
+                "Start_Koinly_Date": str(start),
+                "Last_Koinly_Date": str(last),
+                "Side": str(side),
+                "Amount": str(amount),
+            }
+            for block, start, last, side, amount in zip(
+                df["Block"],
+                df["Start_Koinly_Date"],
+                df["Last_Koinly_Date"],
+                df["Side"],
+                df["Amount"],
+            )
+        ]
+
+
+    # Function to write the loans of the latest blocks at the end of a pair's loan file
+    # The file is cut at the offset and the given blocks, those with rows after it and the new ones,
+    # are formatted together, so their rows are in the order of a full run
+    # The new offset is before the first row that loans of later trades, all dated from the bound
+    # on, may come before, and the blocks with rows after it are returned to be formatted again
+    def append_loan_data(self, file_name, offset, summary_df, bound):
+
+        # Drop the rows after the offset, they are written again below
+        if os.path.exists(file_name):
+            os.truncate(file_name, offset)
+
+        if not summary_df.empty:
+
+            # The block of every formatted row, in the order format_loan_data sorts the rows in
+            dates = np.concatenate(
+                [
+                    (summary_df["Last_Koinly_Date"] + timedelta(minutes=1)).to_numpy(),
+                    (summary_df["Start_Koinly_Date"] - timedelta(minutes=1)).to_numpy(),
+                ]
+            )
+            order = np.argsort(dates, kind="stable")
+            blocks = np.tile(summary_df["Block"].to_numpy(), 2)[order]
+
+            # Rows from the bound on may move, and so may every other row of their blocks and
+            # the rows after those
+            start = int(np.searchsorted(dates[order], np.datetime64(bound), side="left"))
+            while True:
+                moving = np.flatnonzero(np.isin(blocks, blocks[start:]))
+                first = int(moving[0]) if len(moving) else len(blocks)
+                if first == start:
+                    break
+                start = first
+
+            # Write the rows in one go, the offset is after the line of the last row that stays
+            header = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+            data = self.csv_bytes(self.format_loan_data(summary_df), header=header)
+            line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n")) + 1
+            kept = start + header
+            with open(file_name, "ab") as f:
+                f.write(data)
+                offset = f.tell() - len(data) + (int(line_ends[kept - 1]) if kept else 0)
+
+            summary_df = summary_df[summary_df["Block"].isin(blocks[start:])]
+
+        # Do not leave an empty file behind for a side without loans
+        if os.path.exists(file_name) and os.path.getsize(file_name) == 0:
+            os.remove(file_name)
+
+        return offset, summary_df
+
+
+    # Function to continue a pair's blocks and loans with its next chronological trades
+    # The trade data and loan files are appended to, and the state is updated to the last trade
+    def process_new_trades(
+        self, pair, new_trades, state, trade_dir, buy_side_dir, sell_side_dir
+    ):
+
+        # Split the new trades into blocks, continuing the open position
+        new_df = self.segment_blocks(
+            new_trades, state["running_sum"], state["block"]
+        )
+        new_df.index += state["rows"]
+
+        # Append the new rows to the pair's trade data file
+        self.format_decimals(new_df).to_csv(
+            os.path.join(trade_dir, f"{pair}.csv"),
+            mode="a" if state["rows"] else "w",
+            header=not state["rows"],
+            index=True,
+        )
+        self.trade_data[pair] = new_df
+
+        # The last block stays open unless the new trades end on a separator row
+        open_block = (
+            None
+            if pd.isnull(new_df["Koinly Date"].iloc[-1])
+            else new_df["Block"].iloc[-1]
+        )
 
+        # Continue the aggregates of the previously open block with its new trades
+        continued_rows = new_df["Block"] == state["block"]
+        continued = self.update_block_aggregates(
+            state["open_block"], new_df[continued_rows]
+        )
 
-    # Function to process a file using a specific processing function and save the output
-    def process_file(self, file_name, process_func, output_file):
+        # Generate loan summaries for the continued block and the blocks after it
+        summaries = dict(
+            zip(
+                ["Buy", "Sell"],
+                self.generate_loan_summaries(new_df[~continued_rows]),
+            )
+        )
+        for side, summary_df in summaries.items():
+            if continued is not None and continued["side"] == side:
+                summary_df = pd.concat(
+                    [self.block_loan_summary(state["block"], continued), summary_df]
+                )
+            summaries[side] = summary_df
+
+        # Find the aggregates of the block that is still open
+        if open_block is None:
+            open_aggregates = None
+        elif open_block == state["block"]:
+            open_aggregates = continued
+        else:
+            open_aggregates = self.update_block_aggregates(
+                None, new_df[new_df["Block"] == open_block]
+            )
 
-        # Read the input CSV file
-        df = pd.read_csv(f"Original_Files/{file_name}.csv")
+        # Loans of later trades are dated from a minute before the last trade, or before the
+        # start of the open block, whose loans are written again
+        bound = new_trades["Koinly Date"].iloc[-1] - timedelta(minutes=1)
+        if open_aggregates is not None:
+            bound = min(bound, pd.Timestamp(open_aggregates["start"]) - timedelta(minutes=1))
+
+        # Write the loans of the blocks after each file's offset again together with the new ones,
+        # the previously open block's with its new trades
+        for side, directory, offset_key, tail_key in [
+            ("Buy", buy_side_dir, "buy_side_offset", "buy_side_tail"),
+            ("Sell", sell_side_dir, "sell_side_offset", "sell_side_tail"),
+        ]:
+            tail_df = self.loan_tail(state.get(tail_key, []))
+            if continued is not None:
+                tail_df = tail_df[tail_df["Block"] != state["block"]]
+            summary_df = pd.concat(
+                [df for df in [tail_df, summaries[side]] if not df.empty]
+                or [summaries[side]]
+            )
+            state[offset_key], tail_df = self.append_loan_data(
+                os.path.join(directory, f"{pair}.csv"),
+                state[offset_key],
+                summary_df.sort_values("Block", kind="stable"),
+                bound,
+            )
+            state[tail_key] = self.loan_tail_records(tail_df)
+
+        # Save the aggregates of the block that is still open
+        state["open_block"] = open_aggregates
+
+        # Save the position reached by the last processed trade
+        last_timestamp = new_trades["Koinly Date"].iloc[-1]
+        count = int((new_trades["Koinly Date"] == last_timestamp).sum())
+        if state["last_timestamp"] == str(last_timestamp):
+            count += state["last_timestamp_count"]
+        state["last_timestamp"] = str(last_timestamp)
+        state["last_timestamp_count"] = count
+        state["rows"] += len(new_df)
+        state["running_sum"] = int(
+            self.running_sums(new_trades["Amount"], state["running_sum"])[-1]
+        )
+        state["block"] = int(new_df["Block"].iloc[-1])
 
-        # Process the data using the provided function
-        df = process_func(df)
 
-        # Save the processed data to an output CSV file
-        df.to_csv(f"Output/dYdX_{output_file}.csv", index=True)
+
+    # Function to process only the trades newer than each pair's checkpoint
+    @profiled
+    def process_incremental(
+        self,
+        checkpoint_dir="Checkpoints",
+        trade_dir="Trade_Data",
+        buy_side_dir="Buy_Side_Data",
+        sell_side_dir="Sell_Side_Data",
+    ):
+
+        # Create the output directories if they do not exist
+        for directory in [trade_dir, buy_side_dir, sell_side_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+        # Load the position state saved by the previous run for each pair
+        states = {
+            pair: self.load_checkpoint(checkpoint_dir, pair) for pair in self.trade_data
+        }
+
+        # Use at least as many decimals as the saved state of each pair, then rescale that to match
+        for pair, state in states.items():
+            self.raise_decimals(pair, state["decimals"])
+
+        # Iterate over each trading pair in the trade data
+        for pair in self.trade_data:
+
+            state = self.rescale_checkpoint(pair, states[pair])
+
+            # Reverse the order of the data for the current pair
+            df = self.trade_data[pair][::-1]
+
+            # Skip the trades that were already processed, including those sharing the last timestamp
+            start = 0
+            if state["last_timestamp"] is not None:
+                start = (
+                    df["Koinly Date"].searchsorted(
+                        pd.Timestamp(state["last_timestamp"]), side="left"
+                    )
+                    + state["last_timestamp_count"]
+                )
+            new_trades = df.iloc[start:]
+
+            # Nothing to do for pairs without new trades
+            if new_trades.empty:
+                self.trade_data[pair] = new_trades
+                continue
+
+            # Continue the pair's blocks and loans, then save the position it reached
+            self.process_new_trades(
+                pair, new_trades, state, trade_dir, buy_side_dir, sell_side_dir
+            )
+            self.save_checkpoint(checkpoint_dir, pair, state)
+
+        # Find the complete loan files of every pair so they can be merged
+        self.load_loan_data(self.trade_data, buy_side_dir, sell_side_dir)
+
+
+    # Function to find the loan files of the pairs, as written, so they can be merged from disk
+    def load_loan_data(self, pairs, buy_side_dir, sell_side_dir):
+        for files, directory in [
+            (self.buy_side_files, buy_side_dir),
+            (self.sell_side_files, sell_side_dir),
+        ]:
+            for pair in pairs:
+                file_name = os.path.join(directory, f"{pair}.csv")
+                if os.path.exists(file_name):
+                    files[pair] = file_name
+
+
+
+    # Function to process a trades export in chunks of rows, oldest first, with one chunk in memory
+    # The running sum and open block of each pair are carried from chunk to chunk, the trade data
+    # and loans are appended as the blocks close and the checkpoints are saved at the end
+    @profiled
+    def process_trades_file(
+        self,
+        file_name="Trades",
+        output_file="Trades",
+        chunksize=100000,
+        checkpoint_dir="Checkpoints",
+        trade_dir="Trade_Data",
+        buy_side_dir="Buy_Side_Data",
+        sell_side_dir="Sell_Side_Data",
+    ):
+
+        # Create the output directories if they do not exist
+        for directory in [self.output_dir, trade_dir, buy_side_dir, sell_side_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+        output_path = os.path.join(self.output_dir, f"dYdX_{output_file}.csv")
+
+        # Position of every pair and where it first appears in the export
+        states = {}
+        first_seen = {}
+        parts = []
+
+        # The export lists the newest trades first, so its chunks are processed from the last one
+        for number, table in self.export_chunks(file_name, chunksize):
+            if table.num_rows == 0:
+                continue
+
+            # Keep the decimals of each pair's earlier chunks, raising them when this chunk has more
+            self.trade_data = {}
+            df = self.process_trades(
+                self.backend.from_table(table), self.decimals.copy()
+            )
+            del table
+
+            # Save the chunk's Koinly rows to a part file, joined in the export's order below
+            parts.append(f"{output_path}.part{number}")
+            self.write_csv_file(df, parts[-1])
+            del df
+
+            # Continue the blocks and loans of each pair with its trades of the chunk
+            for position, (pair, pair_df) in enumerate(self.trade_data.items()):
+                state = self.rescale_checkpoint(
+                    pair, states.setdefault(pair, self.empty_checkpoint())
+                )
+                first_seen[pair] = (number, position)
+                with self.profile_pair(pair):
+                    self.process_new_trades(
+                        pair,
+                        pair_df[::-1],
+                        state,
+                        trade_dir,
+                        buy_side_dir,
+                        sell_side_dir,
+                    )
+
+        # Join the parts, each one after the first without its header
+        with open(output_path, "wb") as output:
+            for part in reversed(parts):
+                with open(part, "rb") as f:
+                    if part != parts[-1]:
+                        f.readline()
+                    shutil.copyfileobj(f, output)
+                os.remove(part)
+
+        # Save the position of every pair, so later exports can be processed incrementally
+        for pair, state in states.items():
+            self.save_checkpoint(checkpoint_dir, pair, state)
+
+        # The trade data is on disk, find the loans of the pairs in the order of a full run
+        self.trade_data = {}
+        self.load_loan_data(
+            sorted(first_seen, key=first_seen.get), buy_side_dir, sell_side_dir
+        )
+
+
+
+    # Function to check that a run's output files agree with each other and with the exports
+    # Every violation is returned as a row naming the check, the file and the block or date
+    @profiled
+    def verify_outputs(self, trade_dir="Trade_Data", report_file=None):
+
+        reports = []
+
+        # Every Margin Loan is repaid later, in each of the loan files
+        for output_file in ["USDC_Loans", "Crypto_Loans"]:
+            file_name = os.path.join(self.output_dir, f"dYdX_{output_file}.csv")
+            if os.path.exists(file_name):
+                reports.append(self.verify_loans(file_name))
+
+        # Every block of the trade data closes, except the last one of each pair
+        if os.path.isdir(trade_dir):
+            for file_name in sorted(glob.glob(os.path.join(trade_dir, "*.csv"))):
+                reports.append(self.verify_blocks(file_name))
+
+        # Funding day totals are the sums of the exported payments
+        file_name = os.path.join(self.output_dir, "dYdX_Funding.csv")
+        if os.path.exists(file_name) and self.export_files("Funding"):
+            reports.append(self.verify_funding(file_name))
+
+        checked = len(reports)
+        reports = [report for report in reports if not report.empty]
+        report = (
+            pd.concat(reports, ignore_index=True)
+            if reports
+            else self.verification_rows("", "", [], [])
+        )
+
+        # Save and print the result of the checks
+        if report_file is not None:
+            report.to_csv(report_file, index=False)
+        print(f"Verified {checked} files, {len(report)} violations")
+        if not report.empty:
+            print(report.head(20).to_string(index=False))
+
+        return report
+
+
+    # Function to match the Margin Loans of a loans file with later Margin Repayments
+    # of the same currency and amount, reporting those left unmatched
+    def verify_loans(self, file_name):
+
+        df = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+        loans = (df["Label"] == "Margin Loan").to_numpy()
+
+        # Each loan opens one loan of its currency and amount and each repayment closes one
+        currencies = np.where(loans, df["Received Currency"], df["Sent Currency"])
+        amounts = np.where(loans, df["Received Amount"], df["Sent Amount"])
+        keys = pd.MultiIndex.from_arrays([currencies, amounts]).codes
+        keys = keys[0].astype(np.int64) * (keys[1].max(initial=0) + 1) + keys[1]
+        dates = pd.to_datetime(df["Date"]).to_numpy()
+        changes = np.where(loans, 1, -1)
+
+        # Count the open loans of each key in date order, loans first at equal dates
+        # A repayment is unmatched when the count drops to a new low below zero
+        order = np.lexsort((-changes, dates, keys))
+        keys = pd.Series(keys[order])
+        open_loans = pd.Series(changes[order]).groupby(keys, sort=False).cumsum()
+        lowest = open_loans.groupby(keys, sort=False).cummin().clip(upper=0)
+        unmatched_repayments = order[
+            lowest < lowest.groupby(keys, sort=False).shift(fill_value=0)
+        ]
+
+        # The loans left open at the end are unmatched, beyond those closing the unmatched repayments,
+        # they are reported at the last loan of their key
+        remaining = (
+            open_loans.groupby(keys, sort=False).last()
+            - lowest.groupby(keys, sort=False).last()
+        )
+        last_loans = pd.Series(order).groupby(keys, sort=False).last()
+        unmatched_loans = remaining[remaining > 0]
+        last_loans = last_loans[unmatched_loans.index].to_numpy()
+        rows = np.r_[unmatched_repayments, last_loans]
+        labels = currencies[rows] + " " + amounts[rows]
+
+        return self.verification_rows(
+            "Loans",
+            file_name,
+            dates[rows],
+            np.r_[
+                "Margin Repayment of "
+                + labels[: len(unmatched_repayments)]
+                + " without an earlier Margin Loan",
+                unmatched_loans.astype(str).to_numpy()
+                + " Margin Loan(s) of "
+                + labels[len(unmatched_repayments) :]
+                + " without a Margin Repayment",
+            ],
+        )
+
+
+    # Function to check that the amounts of every closed block of a pair's trade data sum to zero
+    def verify_blocks(self, file_name):
+
+        table = pa_csv.read_csv(
+            file_name,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=["Koinly Date", "Amount", "Block"],
+                column_types={
+                    "Koinly Date": pa.string(),
+                    "Amount": pa.string(),
+                    "Block": pa.int64(),
+                },
+                strings_can_be_null=True,
+            ),
+        )
+        decimals = self.count_decimals(table["Amount"])
+        amounts = self.to_scaled(table["Amount"].to_pandas(), decimals).to_numpy(
+            dtype=np.int64, na_value=0
+        )
+
+        # Sum the amounts of each block, separator rows add nothing
+        blocks = table["Block"].to_numpy()
+        order = np.argsort(blocks, kind="stable")
+        blocks = blocks[order]
+        starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]][: len(blocks)])
+        sums = np.add.reduceat(amounts[order], starts) if len(starts) else amounts[:0]
+
+        # The last block of the pair may still be open
+        unclosed = np.flatnonzero(sums != 0)
+        unclosed = unclosed[blocks[starts[unclosed]] != blocks.max(initial=0)]
+        last_rows = order[np.r_[starts[1:], len(blocks)][unclosed] - 1]
+
+        return self.verification_rows(
+            "Blocks",
+            file_name,
+            pd.to_datetime(table["Koinly Date"].take(last_rows).to_pandas()),
+            "Amount sums to " + self.format_scaled(sums[unclosed], decimals),
+            blocks[starts[unclosed]],
+        )
+
+
+    # Function to check the funding day totals against the payments of the funding exports
+    def verify_funding(self, file_name):
+
+        raw = self.read_table("Funding")
+        days = self.parse_timestamps(
+            raw["effectiveAt"].to_pandas(), utc=True
+        ).dt.normalize()
+        payments = self.to_scaled(raw["payment"].to_pandas(), USDC_DECIMALS)
+        expected = payments.groupby(days).sum()
+
+        df = pd.read_csv(file_name, dtype=str)
+        found = self.to_scaled(df["Amount"], USDC_DECIMALS)
+        found.index = pd.to_datetime(df["Koinly Date"], utc=True)
+
+        # Days missing on one side count as mismatches
+        totals = pd.concat({"Expected": expected, "Found": found}, axis=1)
+        mismatched = totals[~(totals["Expected"] == totals["Found"]).fillna(False)]
+
+        return self.verification_rows(
+            "Funding",
+            file_name,
+            mismatched.index.tz_localize(None),
+            "Total "
+            + self.format_scaled(mismatched["Found"], USDC_DECIMALS).fillna("missing")
+            + " instead of the payments sum "
+            + self.format_scaled(mismatched["Expected"], USDC_DECIMALS).fillna("missing"),
+        )
+
+
+    # Function to build the rows of a verification report, with the same columns and types
+    def verification_rows(self, check, file_name, dates, details, blocks=None):
+        return pd.DataFrame(
+            {
+                "Check": check,
+                "File": os.path.basename(file_name),
+                "Block": pd.array(
+                    [pd.NA] * len(dates) if blocks is None else blocks, dtype="Int64"
+                ),
+                "Date": pd.to_datetime(np.asarray(dates)),
+                "Detail": np.asarray(details, dtype=object),
+            }
+        )
+
+
+# Backend running the stage functions with pandas, the reference the other backends match
+class PandasBackend:
+    def __init__(self, processed_trades):
+        # Trades being processed, whose helpers, decimals and results the stages use
+        self.processed_trades = processed_trades
+
+
+    # Function to read an export file for the stage functions
+    def read_input(self, file_name):
+        return self.processed_trades.read_input(file_name)
+
+
+    # Function to turn a parsed export table into the input of the stage functions
+    def from_table(self, table):
+        return table.to_pandas()
 
 
     # Processing function for deposit auto swaps
@@ -63,9 +2716,7 @@ class ProcessedTrades:
     def process_transfers(self, df):
 
         # Convert 'createdAt' column to datetime format
-        df["createdAt"] = pd.to_datetime(
-            df["createdAt"].str.replace("T", " ").str.slice(0, -8)
-        )
+        df["createdAt"] = self.processed_trades.parse_timestamps(df["createdAt"])
 
         # Rename columns for consistency
         df.rename(
@@ -110,53 +2761,60 @@ class ProcessedTrades:
     def process_funding(self, df):
 
         # Convert 'effectiveAt' column to datetime format
-        df["effectiveAt"] = pd.to_datetime(df["effectiveAt"]).dt.normalize()
+        df["effectiveAt"] = self.processed_trades.parse_timestamps(
+            df["effectiveAt"], utc=True
+        ).dt.normalize()
 
-        # Convert 'payment' column to numeric, handling errors
-        df["payment"] = pd.to_numeric(df["payment"], errors="coerce")
+        # Convert 'payment' column to integer USDC amounts, handling errors
+        df["payment"] = self.processed_trades.to_scaled(df["payment"], USDC_DECIMALS)
 
         # Aggregate funding data by date and sum payments
         df = df.groupby(df["effectiveAt"])["payment"].sum().reset_index()
-        df.columns = ["Koinly Date", "Amount"]
 
-        # Round 'Amount' to 10 decimal places
-        df["Amount"] = df["Amount"].round(10)
+        return self.processed_trades.format_funding(df)
 
-        # Assign labels based on 'Amount' values
-        df["Label"] = df["Amount"].apply(
-            lambda x: "Margin Fee" if x < 0 else "Lending Interest"
-        )
 
-        # Assign fixed currency and description
-        df["Currency"] = "USDC"
-        df["Description"] = "Funding"
+    # Processing function for trade data
+    # The decimals of each pair's sizes and prices are found from its trades, at least those given
+    # for the pair
+    def process_trades(self, df, decimals=None):
 
-        # Set 'Koinly Date' as index
-        df.set_index("Koinly Date", inplace=True)
-        return df
+        processed_trades = self.processed_trades
 
+        # Convert 'createdAt' column to datetime format
+        df["Koinly Date"] = processed_trades.parse_timestamps(df["createdAt"])
 
-    # Processing function for trade data
-    def process_trades(self, df):
+        # Capitalize 'side' and add 'C' to 'market' column values
+        # Categoricals only rename their categories
+        if processed_trades.compact:
+            df["side"] = df["side"].cat.rename_categories(str.capitalize)
+            df["market"] = df["market"].cat.rename_categories(lambda x: x + "C")
+        else:
+            df[["side", "market"]] = df[["side", "market"]].apply(
+                lambda x: x.str.capitalize() if x.name == "side" else x + "C"
+            )
 
-        # Convert 'createdAt' column to datetime format
-        df["Koinly Date"] = pd.to_datetime(
-            df["createdAt"].str.replace("T", " ").str.slice(0, -8)
+        # Convert sizes, prices and fees to int64 values scaled by the decimals of their pair
+        decimals = processed_trades.trade_decimals(
+            decimals, df["market"], df["size"], df["price"]
         )
+        df["size"] = processed_trades.to_scaled(df["size"], decimals["Amount"])
+        df["price"] = processed_trades.to_scaled(df["price"], decimals["Price"])
+        df["fee"] = processed_trades.to_scaled(df["fee"], USDC_DECIMALS)
 
-        # Calculate 'Total' column
+        # Calculate 'Total' column, exact with the decimals of size and price combined
+        if (df["size"].abs() > np.iinfo(np.int64).max // df["price"].abs().clip(lower=1)).any():
+            raise OverflowError("Trade totals do not fit in scaled 64-bit integers")
         df["Total"] = df["size"] * df["price"]
 
-        # Capitalize 'side' and add 'C' to 'market' column values
-        df[["side", "market"]] = df[["side", "market"]].apply(
-            lambda x: x.str.capitalize() if x.name == "side" else x + "C"
-        )
-
-        # Drop unnecessary columns
-        df.drop(["liquidity", "type"], axis=1, inplace=True)
+        # Drop unnecessary columns, if they were read
+        df.drop(["liquidity", "type"], axis=1, inplace=True, errors="ignore")
 
         # Assign 'Fee Currency' column
         df["Fee Currency"] = "USDC"
+        if processed_trades.compact:
+            df["Fee Currency"] = df["Fee Currency"].astype("category")
+            df.drop(columns="createdAt", inplace=True)
 
         # Rename columns for consistency
         df.rename(
@@ -186,359 +2844,939 @@ class ProcessedTrades:
 
         # Adjust 'Total' and 'Amount' for sell trades
         df.loc[df["Side"] == "Sell", ["Total", "Amount"]] *= -1
-        df.loc[:, "Fee Amount"] = np.where(
-            df["Fee Amount"] > 0, -df["Fee Amount"], df["Fee Amount"]
-        )
+        df.loc[:, "Fee Amount"] = -df["Fee Amount"].abs()
 
-        # Separate data by unique pairs
-        unique_pairs = df["Pair"].unique()
+        # Separate data by unique pairs, in one pass in the order they first appear
+        for pair, pair_df in df.groupby("Pair", sort=False, observed=True):
+            processed_trades.trade_data[pair] = pair_df
 
-        for pair in unique_pairs:
-            pair_df = df[df["Pair"] == pair]
-            self.trade_data[pair] = pair_df
-
-        # Set 'Koinly Date' as index
+        # Set 'Koinly Date' as index, the exact integer columns are written as decimal strings
         df = df.set_index("Koinly Date")
 
         return df
 
 
-    # Function to generate loan summary from blocks of trade data
-    def generate_loan_summary(self, df, side):
+    # Function to generate the buy-side and sell-side loan summaries in one pass over the blocks
+    # A block is a buy-side loan of USDC when its first trade is a buy, otherwise a sell-side loan of the crypto
+    def generate_loan_summaries(self, df):
+
+        # Only trade rows belong to a block's loan, the separator rows hold no trade
+        trades = df["Side"].notnull().to_numpy()
+
+        # Bring the rows of each block together, they already are after segment_blocks
+        blocks = df["Block"].to_numpy()[trades]
+        order = np.argsort(blocks, kind="stable")
+        blocks = blocks[order]
+
+        # Function to take the trade rows of a column in block order
+        def column(name, **kwargs):
+            return df[name].to_numpy(**kwargs)[trades][order]
+
+        # Find where each block starts and how many trades it has
+        starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]][: len(blocks)])
+        lengths = np.diff(np.r_[starts, len(blocks)])
+        positions = np.arange(len(blocks))
+
+        # The side and pair of each block are those of its first trade, and its decimals the pair's
+        sides = column("Side")[starts]
+        pairs = column("Pair")[starts]
+        decimals = self.processed_trades.row_decimals(pairs)
+
+        # First and last trade date of each block, skipping missing dates
+        dates = column("Koinly Date")
+        dated = ~np.isnat(dates)
+        first = np.minimum.reduceat(np.where(dated, positions, len(dates)), starts)
+        last = np.maximum.reduceat(np.where(dated, positions, -1), starts)
+        start_dates = np.append(dates, np.datetime64("NaT"))[first]
+        last_dates = np.append(dates, np.datetime64("NaT"))[last]
+
+        # Function to find the peak of the running sum of a column within each block
+        # Missing values add nothing to the running sum and are never the peak
+        def running_sum_peaks(name, reduce, skipped):
+            missing = df[name].isnull().to_numpy()[trades][order]
+            values = column(name, dtype=np.int64, na_value=0)
+            running_sum = np.cumsum(values)
+            running_sum -= np.repeat(running_sum[starts] - values[starts], lengths)
+            return pd.arrays.IntegerArray(
+                reduce.reduceat(np.where(missing, skipped, running_sum), starts),
+                np.logical_and.reduceat(missing, starts),
+            )
 
-        # Filter the DataFrame to include only rows where the "Side" column matches the provided `side` value
-        blocks = df[df.groupby("Block")["Side"].transform("first") == side].copy()
+        summaries = []
+        for side, name, reduce, skipped in [
+            ("Buy", "Total", np.maximum, np.iinfo(np.int64).min),
+            ("Sell", "Amount", np.minimum, np.iinfo(np.int64).max),
+        ]:
+            selected = sides == side
+
+            # Buy-side loans are the maximum running sum of "Total" in USDC,
+            # sell-side loans the minimum running sum of "Amount" in the crypto of the pair
+            peaks = pd.Series(running_sum_peaks(name, reduce, skipped)[selected])
+            summaries.append(
+                pd.DataFrame(
+                    {
+                        "Block": blocks[starts][selected],
+                        "Start_Koinly_Date": start_dates[selected],
+                        "Last_Koinly_Date": last_dates[selected],
+                        "Side": (
+                            "USDC"
+                            if side == "Buy"
+                            else pd.Series(pairs[selected], dtype=object).str[:-5]
+                        ),
+                        "Amount": self.processed_trades.format_scaled(
+                            peaks.abs(), decimals[name][selected]
+                        ),
+                    }
+                )
+            )
 
-        # Calculate the running sum within each block
-        # If `side` is "Buy", calculate the running sum of the "Total" column
-        # If `side` is "Sell", calculate the running sum of the "Amount" column
-        blocks.loc[:, "Running_Sum"] = blocks.groupby("Block")[
-            "Total" if side == "Buy" else "Amount"
-        ].cumsum()
+        # Return the buy-side and sell-side loan summary DataFrames
+        return tuple(summaries)
 
-        # Find the maximum or minimum running sum within each block
-        max_min_running_sum = (
-            blocks.groupby("Block")["Running_Sum"]
-            .agg(
-                ["max" if side == "Buy" else "min"]
-            )  # Select "max" if side is "Buy", otherwise select "min"
-            .reset_index()
-        )
 
-        # Create a new DataFrame to store summarized information
-        loan_summary_df = (
-            blocks.groupby("Block")
-            .agg(
-                Start_Koinly_Date=(
-                    "Koinly Date",
-                    "first",
-                ),  # First Koinly date within each block
-                Last_Koinly_Date=(
-                    "Koinly Date",
-                    "last",
-                ),  # Last Koinly date within each block
-                Side=(
-                    "Pair",
-                    "first",
-                ),  # First trading pair encountered within each block
-            )
-            .reset_index()
-        )
+    # Function to split chronologically ordered trades of one pair into position blocks
+    # The running sum and block number can be carried over from previously processed trades
+    def segment_blocks(self, df, running_sum=0, block=0):
 
-        # Merge the maximum or minimum running sum values into the new DataFrame
-        loan_summary_df = loan_summary_df.merge(max_min_running_sum, on="Block")
+        # Calculate the exact integer running sum of the "Amount" column
+        running_sum = self.processed_trades.running_sums(df["Amount"], running_sum)
 
-        # Rename the column indicating maximum or minimum running sum to "Amount"
-        loan_summary_df.rename(
-            columns={"max" if side == "Buy" else "min": "Amount"}, inplace=True
-        )
+        # Identify rows where the running sum returns to zero, closing the position
+        closes = running_sum == 0
+
+        # Every closing row is followed by a separator row, so take those positions twice
+        repeats = np.where(closes, 2, 1)
+        positions = np.repeat(np.arange(len(df)), repeats)
 
-        # Adjust the "Amount" column values
-        loan_summary_df["Amount"] = loan_summary_df["Amount"].apply(
-            lambda x: x if isinstance(x, str) else str(x).replace("-", "")
+        # Flag the second copy of each closing row as a separator
+        separators = np.zeros(len(positions), dtype=bool)
+        separators[np.cumsum(repeats)[closes] - 1] = True
+
+        # Take every column once, with the separator rows missing, into a frame with a fresh index
+        # Integer columns become nullable, the other columns keep their dtype
+        rows = np.where(separators, -1, positions)
+        columns = {}
+        for name, values in df.items():
+            if pd.api.types.is_integer_dtype(values) and not isinstance(
+                values.dtype, pd.api.extensions.ExtensionDtype
+            ):
+                values = values.astype("Int64")
+            columns[name] = values.array.take(rows, allow_fill=True)
+        columns["Running Sum"] = pd.arrays.IntegerArray(
+            running_sum[positions], separators
         )
+        new_df = pd.DataFrame(columns, copy=False)
 
-        # Adjust the "Side" column values based on the `side` parameter
-        if side == "Buy":
-            loan_summary_df["Side"] = "USDC"
+        # Assign block numbers, a new block starts at each separator row
+        new_df["Block"] = separators.cumsum() + block
 
-        elif side == "Sell":
-            loan_summary_df["Side"] = loan_summary_df["Side"].apply(
-                lambda x: x[:-5]
-            )  # Remove last five characters
+        return new_df
 
-        # Return the generated loan summary DataFrame
-        return loan_summary_df
 
+# Backend running the stage functions with pyarrow compute on the Arrow tables of the exports
+# The columns are parsed, computed and reordered in Arrow, and the results are converted to
+# the same DataFrames as those of the pandas backend, so the writers and later stages share them
+class ArrowBackend(PandasBackend):
 
-    # Function to process trade data
-    def process_granular_data(self):
+    # Function to read an export file as the Arrow table parsed with its declared schema
+    def read_input(self, file_name):
+        if file_name not in SCHEMAS:
+            return super().read_input(file_name)
+        return self.processed_trades.read_table(file_name)
 
-        # Iterate over each trading pair in the trade data
-        for pair in self.trade_data:
 
-            # Reverse the order of the data for the current pair
-            self.trade_data[pair] = self.trade_data[pair][::-1]
-
-            # Calculate the running sum of the "Amount" column for the current pair
-            self.trade_data[pair]["Running Sum"] = self.trade_data[pair][
-                "Amount"
-            ].cumsum()
-
-            # Round the running sum to 8 decimal places for precision
-            self.trade_data[pair]["Running Sum"] = self.trade_data[pair][
-                "Running Sum"
-            ].round(8)
-
-            # Identify rows with zero running sum
-            rows_with_zeros = (
-                self.trade_data[pair]
-                .index[
-                    (self.trade_data[pair]["Running Sum"] == 0)
-                    | (self.trade_data[pair]["Running Sum"] == -0)
-                ]
-                .to_list()
-            )
+    # Function to hand a parsed export table to the stage functions as it is
+    def from_table(self, table):
+        return table
 
-            # Create new rows to replace rows with zero running sum
-            new_rows = []
 
-            for index, row in self.trade_data[pair].iterrows():
+    # Function to get a stage's input as an Arrow table, converting the DataFrames of callers
+    def table(self, df, columns=None):
+        if isinstance(df, pa.Table):
+            return df if columns is None else df.select(columns)
+        return pa.Table.from_pandas(
+            df if columns is None else df[columns], preserve_index=False
+        )
 
-                # Add the current row to the list of new rows
-                new_rows.append(row.to_dict())
 
-                # If the current row has zero running sum, add a new row with NaN values for all columns
-                if index in rows_with_zeros:
-                    new_rows.append(
-                        {col: np.nan for col in self.trade_data[pair].columns}
-                    )
+    # Function to convert an Arrow table to a DataFrame, with nullable Int64 integer columns
+    def to_frame(self, table):
+        return table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+    # Function to find the order in which pandas' sort_index puts timestamps, ties included
+    # Nothing is moved when they are already sorted, otherwise missing timestamps come last
+    def sort_indices(self, timestamps):
 
-            # Create a new DataFrame with the modified rows
-            new_df = pd.DataFrame(new_rows)
+        values = pc.fill_null(timestamps.cast(pa.int64()), 0).to_numpy()
+        missing = timestamps.is_null().to_numpy(zero_copy_only=False)
+        positions = np.arange(len(values))
+        if not missing.any() and (values[1:] >= values[:-1]).all():
+            return positions
 
-            # Reset the index of the new DataFrame and drop the old index
-            new_df.reset_index(drop=True, inplace=True)
+        return np.concatenate(
+            [
+                positions[~missing][np.argsort(values[~missing], kind="quicksort")],
+                positions[missing],
+            ]
+        )
 
-            # Assign block numbers to the data based on the presence of null values in the "Koinly Date" column
-            new_df["Block"] = new_df["Koinly Date"].isnull().cumsum()
 
-            # Update the trade data with the modified DataFrame for the current pair
-            self.trade_data[pair] = new_df
+    # Processing function for deposit auto swaps
+    def process_deposit_swaps(self, df):
 
-            # Generate loan summaries for buy and sell sides for the current pair
-            self.buy_side_data[pair] = self.generate_loan_summary(
-                self.trade_data[pair], "Buy"
-            )
-            self.sell_side_data[pair] = self.generate_loan_summary(
-                self.trade_data[pair], "Sell"
+        # Keep the transfers of other assets than USDC, and those without an asset
+        table = self.table(df)
+        table = table.filter(pc.fill_null(pc.not_equal(table["debitAsset"], "USDC"), True))
+        df = self.to_frame(
+            table.select(
+                [
+                    "createdAt",
+                    "debitAmount",
+                    "debitAsset",
+                    "creditAmount",
+                    "creditAsset",
+                    "transactionHash",
+                ]
+            ).rename_columns(
+                [
+                    "Date",
+                    "Sent Amount",
+                    "Sent Currency",
+                    "Received Amount",
+                    "Received Currency",
+                    "TxHash",
+                ]
             )
+        )
 
+        # Add the additional columns with empty values or specified values
+        df["Fee Amount"] = ""
+        df["Fee Currency"] = "USDC"
+        df["Label"] = "Swap"
+        df["Description"] = "Auto Deposit"
+        df.set_index("Date", inplace=True)
 
-    # Function to format loan data
-    def format_loan_data(self, df):
+        return df
 
-        # Calculate start dates by subtracting 1 minute from "Start_Koinly_Date"
-        start_dates = (df["Start_Koinly_Date"] - timedelta(minutes=1)).tolist()
 
-        # Calculate last dates by adding 1 minute to "Last_Koinly_Date"
-        last_dates = (df["Last_Koinly_Date"] + timedelta(minutes=1)).tolist()
+    # Processing function for transfers data
+    def process_transfers(self, df):
 
-        # Extract sides and values from DataFrame
-        sides = df["Side"].tolist()
-        values = df["Amount"].tolist()
+        table = self.table(df)
+        dates = self.processed_trades.timestamp_array(table["createdAt"])
 
-        # Define labels for loan and repayment
-        label_loan = "Margin Loan"
-        label_repayment = "Margin Repayment"
+        # Write the amounts as Python writes floats, which Arrow's cast to strings does not,
+        # with a minus sign for fast withdrawals
+        amounts = pa.array(
+            table["debitAmount"].to_numpy().astype(str), type=pa.string()
+        )
+        amounts = pc.if_else(
+            pc.fill_null(pc.equal(table["type"], "FAST_WITHDRAWAL"), False),
+            pc.binary_join_element_wise("-", amounts, ""),
+            amounts,
+        )
 
-        # Create dictionary for receiving loan
-        receive_loan = {
-            "Date": start_dates,
-            "Received Amount": values,
-            "Received Currency": sides,
-            "Sent Amount": "",
-            "Sent Currency": "",
-            "Label": label_loan,
-        }
+        # Rename the other columns and add the amounts after them
+        renamed = {"debitAsset": "Currency", "transactionHash": "TxHash"}
+        names = [
+            name
+            for name in table.column_names
+            if name not in ["createdAt", "type", "debitAmount"]
+        ]
+        table = pa.table(
+            [dates] + [table[name] for name in names] + [amounts],
+            names=["Koinly Date"] + [renamed.get(name, name) for name in names] + ["Amount"],
+        )
 
-        # Create dictionary for loan repayment
-        return_loan = {
-            "Date": last_dates,
-            "Received Amount": "",
-            "Received Currency": "",
-            "Sent Amount": values,
-            "Sent Currency": sides,
-            "Label": label_repayment,
-        }
+        # Sort by date in the same order as the pandas backend
+        table = table.take(self.sort_indices(dates))
+        return self.to_frame(table).set_index("Koinly Date")
 
-        # Create DataFrames from loan receive and repayment dictionaries
-        receive_df = pd.DataFrame(receive_loan)
-        return_df = pd.DataFrame(return_loan)
 
-        # Concatenate DataFrames for loan receive and repayment
-        formatted_df = pd.concat([receive_df, return_df])
+    # Processing function for funding data
+    def process_funding(self, df):
 
-        # Sort DataFrame by date
-        formatted_df = formatted_df.sort_values(by="Date")
+        # Sum the exact integer payments of each day, days without a date are dropped
+        table = self.table(df)
+        totals = (
+            pa.table(
+                {
+                    "effectiveAt": pc.floor_temporal(
+                        self.processed_trades.timestamp_array(
+                            table["effectiveAt"], utc=True
+                        ),
+                        unit="day",
+                    ),
+                    "payment": self.processed_trades.scaled_array(
+                        table["payment"], USDC_DECIMALS
+                    ),
+                }
+            )
+            .group_by("effectiveAt")
+            .aggregate([("payment", "sum", pc.ScalarAggregateOptions(min_count=0))])
+        )
+        totals = totals.filter(pc.is_valid(totals["effectiveAt"])).sort_by("effectiveAt")
 
-        # Set "Date" column as index
-        formatted_df.set_index("Date", inplace=True)
-        return formatted_df
+        return self.processed_trades.format_funding(
+            self.to_frame(totals.select(["effectiveAt", "payment_sum"]))
+        )
 
 
-    # Function to process loan data
-    def process_loan_data(self, data):
+    # Processing function for trade data
+    # The decimals of each pair's sizes and prices are found from its trades, at least those given
+    # for the pair
+    def process_trades(self, df, decimals=None):
 
-        # Iterate over each symbol and its corresponding DataFrame in the provided data
-        for symbol, df in data.items():
+        processed_trades = self.processed_trades
+        table = self.table(df)
 
-            # Process the loan data DataFrame using the format_loan_data function
-            processed_df = self.format_loan_data(df)
+        # Capitalize the sides and add "C" to the markets, categoricals are read as text
+        sides = pc.utf8_capitalize(table["side"].cast(pa.string()))
+        pairs = pc.binary_join_element_wise(table["market"].cast(pa.string()), "C", "")
 
-            # Replace the original DataFrame in the data dictionary with the processed DataFrame
-            data[symbol] = processed_df
+        pairs = pc.dictionary_encode(pairs.combine_chunks())
 
+        # Convert sizes, prices and fees to int64 values scaled by the decimals of their pair
+        decimals = processed_trades.trade_decimals(
+            decimals, pairs, table["size"], table["price"]
+        )
+        amounts = processed_trades.scaled_array(table["size"], decimals["Amount"])
+        prices = processed_trades.scaled_array(table["price"], decimals["Price"])
+        fees = processed_trades.scaled_array(table["fee"], USDC_DECIMALS)
+
+        # Calculate the totals, exact with the decimals of size and price combined
+        try:
+            totals = pc.multiply_checked(amounts, prices)
+        except pa.ArrowInvalid:
+            raise OverflowError(
+                "Trade totals do not fit in scaled 64-bit integers"
+            ) from None
+
+        # Negate the totals and amounts of sell trades, fees are always negative
+        sells = pc.fill_null(pc.equal(sides, "Sell"), False)
+        columns = {
+            "Koinly Date": processed_trades.timestamp_array(table["createdAt"]),
+            "Pair": pairs if processed_trades.compact else pairs.cast(pa.string()),
+            "Side": sides,
+            "Amount": pc.if_else(sells, pc.negate(amounts), amounts),
+            "Price": prices,
+            "Total": pc.if_else(sells, pc.negate(totals), totals),
+            "Fee Amount": pc.negate(pc.abs(fees)),
+            "Fee Currency": pa.repeat("USDC", table.num_rows),
+        }
+        if processed_trades.compact:
+            for name in ["Side", "Fee Currency"]:
+                columns[name] = pc.dictionary_encode(columns[name])
+        df = self.to_frame(pa.table(columns))
+
+        # Separate data by unique pairs, in the order they first appear, from one stable sort
+        # of the pairs' codes, trades without a pair are left out
+        codes = pc.fill_null(pairs.indices, -1).to_numpy()
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(pairs.dictionary) + 1))
+        pair_rows = df.take(order)
+        for pair, start, end in zip(
+            pairs.dictionary.to_pylist(), bounds[:-1], bounds[1:]
+        ):
+            processed_trades.trade_data[pair] = pair_rows.iloc[start:end]
+
+        # Set 'Koinly Date' as index, the exact integer columns are written as decimal strings
+        df = df.set_index("Koinly Date")
 
-    # Function to process buy-side loans
-    def process_buy_side_loans(self):
+        return df
 
-        # Process loan data for buy-side loans using the process_loan_data function
-        self.process_loan_data(self.buy_side_data)
 
+    # Function to generate the buy-side and sell-side loan summaries in one pass over the blocks
+    # A block is a buy-side loan of USDC when its first trade is a buy, otherwise a sell-side loan of the crypto
+    def generate_loan_summaries(self, df):
+
+        # Only trade rows belong to a block's loan, the separator rows hold no trade
+        table = self.table(df, ["Block", "Side", "Pair", "Koinly Date", "Total", "Amount"])
+        table = table.filter(pc.is_valid(table["Side"]))
+
+        # Bring the rows of each block together, they already are after segment_blocks
+        table = table.take(pc.sort_indices(table["Block"]))
+
+        # Find where each block starts and how many trades it has
+        blocks = table["Block"].to_numpy()
+        starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]][: len(blocks)])
+        lengths = np.diff(np.r_[starts, len(blocks)])
+        row_blocks = np.repeat(np.arange(len(starts)), lengths)
+
+        # The side and pair of each block are those of its first trade, and its decimals the pair's
+        sides = table["Side"].take(starts).cast(pa.string())
+        pairs = table["Pair"].take(starts).cast(pa.string())
+        decimals = self.processed_trades.row_decimals(pairs)
+
+        # Function to find the running sum of a column within each block
+        # Missing values add nothing to the running sum and are never the peak
+        def block_running_sums(name):
+            values = pc.fill_null(table[name], 0)
+            running_sum = pc.cumulative_sum(values)
+            offsets = pc.subtract(running_sum.take(starts), values.take(starts))
+            return pc.if_else(
+                pc.is_valid(table[name]),
+                pc.subtract(running_sum, offsets.take(row_blocks)),
+                pa.scalar(None, pa.int64()),
+            )
 
-    # Function to process sell-side loans
-    def process_sell_side_loans(self):
+        # First and last trade date of each block, skipping missing dates, and the
+        # peaks of the running sums, in one grouping of the blocks in their order
+        aggregates = pa.table(
+            {
+                "Block": table["Block"],
+                "Koinly Date": table["Koinly Date"],
+                "Total": block_running_sums("Total"),
+                "Amount": block_running_sums("Amount"),
+            }
+        ).group_by("Block", use_threads=False).aggregate(
+            [
+                ("Koinly Date", "first"),
+                ("Koinly Date", "last"),
+                ("Total", "max"),
+                ("Amount", "min"),
+            ]
+        )
 
-        # Process loan data for sell-side loans using the process_loan_data function
-        self.process_loan_data(self.sell_side_data)
+        summaries = []
+        for side, name, aggregation in [
+            ("Buy", "Total", "max"),
+            ("Sell", "Amount", "min"),
+        ]:
+            selected = pc.fill_null(pc.equal(sides, side), False)
+            side_blocks = aggregates.filter(selected)
+
+            # Buy-side loans are the maximum running sum of "Total" in USDC,
+            # sell-side loans the minimum running sum of "Amount" in the crypto of the pair
+            peaks = pc.abs(side_blocks[f"{name}_{aggregation}"])
+            summaries.append(
+                pd.DataFrame(
+                    {
+                        "Block": side_blocks["Block"].to_numpy(),
+                        "Start_Koinly_Date": side_blocks["Koinly Date_first"].to_numpy(),
+                        "Last_Koinly_Date": side_blocks["Koinly Date_last"].to_numpy(),
+                        "Side": (
+                            "USDC"
+                            if side == "Buy"
+                            else pc.utf8_slice_codeunits(
+                                pairs.filter(selected), 0, -5
+                            ).to_numpy(zero_copy_only=False)
+                        ),
+                        "Amount": self.processed_trades.format_scaled(
+                            self.processed_trades.nullable_integers(peaks),
+                            decimals[name][selected.to_numpy()],
+                        ),
+                    }
+                )
+            )
 
+        # Return the buy-side and sell-side loan summary DataFrames
+        return tuple(summaries)
 
-    # Function to merge loan data
-    def merge_loans(self):
 
-        # Collect non-empty dataframes for buy and sell sides
-        buy_data_values = [
-            value for value in self.buy_side_data.values() if not value.empty
-        ]
-        sell_data_values = [
-            value for value in self.sell_side_data.values() if not value.empty
-        ]
+    # Function to split chronologically ordered trades of one pair into position blocks
+    # The running sum and block number can be carried over from previously processed trades
+    def segment_blocks(self, df, running_sum=0, block=0):
 
-        # Concatenate dataframes for buy side loans and save to CSV
-        merged_buy_df = pd.concat(buy_data_values)
-        merged_buy_df.reset_index(inplace=True)  # Reset the index
-        merged_buy_df.sort_values(by="Date", inplace=True)  # Sort by date
-        merged_buy_df.set_index("Date", inplace=True)  # Set "Date" as index
-        merged_buy_df.to_csv("Output/dYdX_USDC_Loans.csv", index=True)  # Save to CSV
+        table = self.table(df)
+        if table["Amount"].null_count:
+            raise ValueError("Trades without an amount cannot be split into blocks")
 
-        # Concatenate dataframes for sell side loans and save to CSV
-        merged_sell_df = pd.concat(sell_data_values)
-        merged_sell_df.reset_index(inplace=True)  # Reset the index
-        merged_sell_df.sort_values(by="Date", inplace=True)  # Sort by date
-        merged_sell_df.set_index("Date", inplace=True)  # Set "Date" as index
-        merged_sell_df.to_csv("Output/dYdX_Crypto_Loans.csv", index=True)  # Save to CSV
+        # Calculate the exact integer running sum of the "Amount" column
+        running_sum = pc.cumulative_sum(table["Amount"], start=running_sum)
 
-        # Return the merged DataFrames for buy and sell side loans
-        return merged_buy_df, merged_sell_df
+        # Identify rows where the running sum returns to zero, closing the position
+        closes = pc.equal(running_sum, 0).to_numpy()
 
+        # Every closing row is followed by a separator row, so take those positions twice
+        repeats = np.where(closes, 2, 1)
+        positions = np.repeat(np.arange(len(closes)), repeats)
 
-    # Instance method to access data DataFrame by type
-    def access_data(self, data_type, pair=None):
+        # Flag the second copy of each closing row as a separator
+        separators = np.zeros(len(positions), dtype=bool)
+        separators[np.cumsum(repeats)[closes] - 1] = True
 
-        # Determine the data dictionary based on the specified data type
-        if data_type == "trade":
-            data_dict = self.trade_data
-        elif data_type == "buy_side":
-            data_dict = self.buy_side_data
-        elif data_type == "sell_side":
-            data_dict = self.sell_side_data
-        else:
+        # Take every column once, with the separator rows missing, into a frame with a fresh index
+        rows = pa.array(positions, mask=separators)
+        new_df = self.to_frame(
+            table.take(rows).append_column("Running Sum", running_sum.take(rows))
+        )
 
-            # Raise a ValueError if an invalid data type is provided
+        # Assign block numbers, a new block starts at each separator row
+        new_df["Block"] = separators.cumsum() + block
+
+        return new_df
+
+
+# Backends running the stage functions, chosen by name
+BACKENDS = {"pandas": PandasBackend, "arrow": ArrowBackend}
+
+
+# Function to process one pair's trades inside a worker process
+# The stages recorded by the worker are returned with the results when profiling
+def process_pair_data(df, decimals, profile=False, backend="pandas"):
+    processed_trades = ProcessedTrades(profile=profile, backend=backend)
+    processed_trades.decimals = decimals
+    result = processed_trades.process_pair(df)
+    return result, processed_trades.profiler.records if profile else []
+
+
+# Stages of the pipeline, each with the inputs it needs, what it writes and the function that runs it
+# Inputs are export files, read through read_input, or other stages that must have finished
+# Outputs are files and folders in the output directory, the Parquet store or the output root
+# Stages are named after what they write, "Blocks" and the side loans are kept in memory only
+PIPELINE_STAGES = {
+    "Transfers": {
+        "inputs": ["Transfers.csv"],
+        "outputs": ["Output/dYdX_Transfers.csv", "Store/dYdX_Transfers"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_file(
+            "Transfers", processed_trades.process_transfers, "Transfers"
+        ),
+    },
+    "Deposit_Swaps": {
+        "inputs": ["Transfers.csv"],
+        "outputs": ["Output/dYdX_Deposit_Swaps.csv", "Store/dYdX_Deposit_Swaps"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_file(
+            "Transfers", processed_trades.process_deposit_swaps, "Deposit_Swaps"
+        ),
+    },
+    "Funding": {
+        "inputs": ["Funding.csv"],
+        "outputs": [
+            "Output/dYdX_Funding.csv",
+            "Output/dYdX_Funding_By_Market.csv",
+            "Store/dYdX_Funding",
+            "Store/dYdX_Funding_By_Market",
+        ],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_funding_stage(),
+    },
+    "Trades": {
+        "inputs": ["Trades.csv"],
+        "outputs": ["Output/dYdX_Trades.csv", "Store/dYdX_Trades"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_file(
+            "Trades", processed_trades.process_trades, "Trades"
+        ),
+    },
+    "Blocks": {
+        "inputs": ["Trades"],
+        "outputs": [],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_granular_data(
+            workers
+        ),
+    },
+    "Buy_Side_Loans": {
+        "inputs": ["Blocks"],
+        "outputs": [],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_buy_side_loans(),
+    },
+    "Sell_Side_Loans": {
+        "inputs": ["Blocks"],
+        "outputs": [],
+        "run": lambda processed_trades, output_root, workers: processed_trades.process_sell_side_loans(),
+    },
+    "Loans": {
+        "inputs": ["Buy_Side_Loans", "Sell_Side_Loans"],
+        "outputs": [
+            "Output/dYdX_USDC_Loans.csv",
+            "Output/dYdX_Crypto_Loans.csv",
+            "Store/dYdX_USDC_Loans",
+            "Store/dYdX_Crypto_Loans",
+        ],
+        "run": lambda processed_trades, output_root, workers: processed_trades.merge_loans(
+            return_frames=False
+        ),
+    },
+    "Trade_Data": {
+        "inputs": ["Blocks"],
+        "outputs": ["Trade_Data", "Store/Trade_Data"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.save_data(
+            processed_trades.trade_data, os.path.join(output_root, "Trade_Data")
+        ),
+    },
+    "Buy_Side_Data": {
+        "inputs": ["Buy_Side_Loans"],
+        "outputs": ["Buy_Side_Data", "Store/Buy_Side_Data"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.save_data(
+            processed_trades.buy_side_data, os.path.join(output_root, "Buy_Side_Data")
+        ),
+    },
+    "Sell_Side_Data": {
+        "inputs": ["Sell_Side_Loans"],
+        "outputs": ["Sell_Side_Data", "Store/Sell_Side_Data"],
+        "run": lambda processed_trades, output_root, workers: processed_trades.save_data(
+            processed_trades.sell_side_data, os.path.join(output_root, "Sell_Side_Data")
+        ),
+    },
+}
+
+
+# Function to find the stages needed for the targets, in the order they are declared
+def select_stages(targets=None):
+
+    if targets is None:
+        return list(PIPELINE_STAGES)
+
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in PIPELINE_STAGES:
             raise ValueError(
-                "Invalid data type. Choose from 'trade', 'buy_side', or 'sell_side'."
+                f"Invalid stage {name!r}. Choose from {', '.join(PIPELINE_STAGES)}."
+            )
+        if name not in selected:
+            selected.add(name)
+            pending.extend(
+                stage
+                for stage in PIPELINE_STAGES[name]["inputs"]
+                if stage in PIPELINE_STAGES
             )
 
-        # If pair is specified, return the DataFrame corresponding to that pair
-        if pair:
-            return data_dict.get(pair)
+    return [name for name in PIPELINE_STAGES if name in selected]
+
+
+# Function to build the cache key of a stage from the content of the export files it depends on
+# and the formats it writes
+def stage_cache_key(processed_trades, name):
+
+    exports = set()
+    pending = [name]
+    while pending:
+        for input_name in PIPELINE_STAGES[pending.pop()]["inputs"]:
+            if input_name.endswith(".csv"):
+                exports.add(input_name[: -len(".csv")])
+            else:
+                pending.append(input_name)
+
+    return processed_trades.cache_key(
+        "stage",
+        name,
+        processed_trades.write_csv,
+        processed_trades.store_dir is not None,
+        # Runs saving the funding per market write one more file
+        name == "Funding" and processed_trades.funding_by_market,
+        [
+            [
+                processed_trades.file_digest(path)
+                for path in processed_trades.export_files(file_name)
+            ]
+            for file_name in sorted(exports)
+        ],
+    )
 
-        # Otherwise, return the entire data dictionary
-        return data_dict
 
+# Function to find the stages whose outputs can be restored from the cache instead of running them
+# A stage is skipped only when every selected stage using its results is skipped too, so the data
+# they need in memory is there, and a stage without outputs only when some stage uses it
+def cached_stages(processed_trades, stages, keys):
 
-    # Instance method to save all data DataFrames into a folder
-    def save_data(self, data_dict, directory):
+    skipped = set()
+    for name in reversed(stages):
+        dependents = [
+            stage for stage in stages if name in PIPELINE_STAGES[stage]["inputs"]
+        ]
+        if not all(stage in skipped for stage in dependents):
+            continue
+        if PIPELINE_STAGES[name]["outputs"]:
+            if processed_trades.cache_entry(keys[name]) is not None:
+                skipped.add(name)
+        elif dependents:
+            skipped.add(name)
+
+    return skipped
+
+
+# Function to find where an output of a stage is written, None for the store when it is not used
+def stage_output_path(processed_trades, output_root, output):
+
+    folder, _, name = output.partition("/")
+    if folder == "Output":
+        return os.path.join(processed_trades.output_dir, name)
+    if folder == "Store":
+        if processed_trades.store_dir is None:
+            return None
+        return os.path.join(processed_trades.store_dir, name)
+    return os.path.join(output_root, output)
+
+
+# Function to copy the outputs of a stage to or from its cache entry
+def copy_stage_outputs(processed_trades, name, output_root, entry, restore=False):
+
+    for output in PIPELINE_STAGES[name]["outputs"]:
+        output_path = stage_output_path(processed_trades, output_root, output)
+        if output_path is None:
+            continue
+        source, target = output_path, os.path.join(entry, output)
+        if restore:
+            source, target = target, source
+
+        if os.path.isdir(source):
+            # Datasets of the Parquet store are replaced, as save_store does
+            if output.startswith("Store/"):
+                shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, target, dirs_exist_ok=True)
+        elif os.path.isfile(source):
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            shutil.copyfile(source, target)
+
+
+# Function to run a stage, then to save what it wrote in the cache when it is used
+def run_stage(processed_trades, name, output_root, workers, key=None):
+
+    PIPELINE_STAGES[name]["run"](processed_trades, output_root, workers)
+
+    if key is not None and PIPELINE_STAGES[name]["outputs"]:
+        processed_trades.save_cache_entry(
+            key,
+            lambda entry: copy_stage_outputs(processed_trades, name, output_root, entry),
+        )
 
-        # Create the directory if it does not exist
-        if not os.path.exists(directory):
-            os.makedirs(directory)
 
-        # Iterate through each pair and DataFrame in the data dictionary
-        for pair, df in data_dict.items():
+# Function to run the stages needed for the targets, each as soon as its inputs are ready
+# Independent stages run concurrently in threads, one at a time when profiling so each is measured alone
+# With a cache, the stages an earlier run did with the same exports are restored from it instead
+def run_stages(
+    processed_trades, output_root=".", targets=None, workers=None, threads=None
+):
+
+    stages = select_stages(targets)
+
+    # Restore the outputs of the cached stages, they leave no data in memory
+    keys = {}
+    skipped = set()
+    if processed_trades.cache_dir is not None:
+        keys = {name: stage_cache_key(processed_trades, name) for name in stages}
+        skipped = cached_stages(processed_trades, stages, keys)
+        for name in stages:
+            if name in skipped:
+                copy_stage_outputs(
+                    processed_trades,
+                    name,
+                    output_root,
+                    os.path.join(processed_trades.cache_dir, keys[name]),
+                    restore=True,
+                )
+
+    # Share each export file between the stages reading it, so it is parsed only once
+    for name in stages:
+        if name in skipped:
+            continue
+        for file_name in PIPELINE_STAGES[name]["inputs"]:
+            if file_name.endswith(".csv"):
+                file_name = file_name[: -len(".csv")]
+                processed_trades.input_uses[file_name] = (
+                    processed_trades.input_uses.get(file_name, 0) + 1
+                )
+
+    if processed_trades.profiler is not None:
+        threads = 1
+
+    done = set(skipped)
+    running = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while len(done) < len(stages):
+
+            # Start every stage whose inputs are ready
+            for name in stages:
+                if name in done or name in running.values():
+                    continue
+                if all(
+                    stage in done
+                    for stage in PIPELINE_STAGES[name]["inputs"]
+                    if stage in PIPELINE_STAGES
+                ):
+                    future = executor.submit(
+                        run_stage,
+                        processed_trades,
+                        name,
+                        output_root,
+                        workers,
+                        keys.get(name),
+                    )
+                    running[future] = name
+
+            # Wait for a stage to finish, a failing stage stops the run
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                done.add(name)
+
+    # Release the export files of stages that did not run
+    processed_trades.inputs.clear()
+    processed_trades.input_uses.clear()
+
+    # Bring the cache back under its size once no stage reads it, with the entries of this run
+    if processed_trades.cache_dir is not None:
+        processed_trades.evict_cache(keep_used=False)
+
+    return processed_trades
+
+
+# Function to run the full pipeline for one account, or only the stages needed for the targets
+# The formats are "csv" for the CSV files and "parquet" for the Parquet store
+# With profile, a report of the time, rows and memory of each stage is saved as Profile.json
+# With compact, repeated text is kept as categoricals to reduce the memory of large accounts
+# The csv_writer is "pandas" or "arrow", a faster writer of the same bytes
+# With verify, the output files are checked afterwards and a ValueError is raised if they disagree
+# With a cache_dir, parsed exports and results are cached there for runs with the same exports
+# The backend is "pandas" or "arrow", which runs the stage functions with pyarrow compute
+# With a funding_chunksize, Funding.csv is read in chunks of that many rows, and with
+# funding_by_market the daily funding per market is saved as well
+def run_pipeline(
+    input_dir="Original_Files",
+    output_root=".",
+    workers=None,
+    formats=("csv",),
+    profile=False,
+    targets=None,
+    threads=None,
+    compact=False,
+    csv_writer="pandas",
+    verify=False,
+    cache_dir=None,
+    cache_size=CACHE_SIZE,
+    backend="pandas",
+    funding_chunksize=None,
+    funding_by_market=False,
+):
+
+    # Create an instance of the ProcessedTrades class
+    processed_trades = ProcessedTrades(
+        input_dir=input_dir,
+        output_dir=os.path.join(output_root, "Output"),
+        store_dir=os.path.join(output_root, "Store") if "parquet" in formats else None,
+        write_csv="csv" in formats,
+        profile=profile,
+        compact=compact,
+        csv_writer=csv_writer,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        backend=backend,
+        funding_chunksize=funding_chunksize,
+        funding_by_market=funding_by_market,
+    )
+
+    # Run the stages, transfers, swaps and funding alongside the trades, blocks and loans
+    run_stages(processed_trades, output_root, targets, workers, threads)
+
+    # Check the output files, saving the violations found as Verification.csv
+    if verify:
+        report = processed_trades.verify_outputs(
+            os.path.join(output_root, "Trade_Data"),
+            os.path.join(output_root, "Verification.csv"),
+        )
+        if not report.empty:
+            raise ValueError(
+                f"{len(report)} verification checks failed, see Verification.csv"
+            )
 
-            # Check if the DataFrame is not empty
-            if not df.empty:
+    # Save the profile of the run
+    if profile:
+        processed_trades.save_profile(os.path.join(output_root, "Profile.json"))
 
-                # Construct the file name based on the pair and directory
-                file_name = os.path.join(directory, f"{pair}.csv")
+    return processed_trades
 
-                # Save the DataFrame to a CSV file in the specified directory
-                df.to_csv(file_name, index=True)
 
+# Function to run the pipeline for one account inside a worker process
+def run_account(account, input_dir, output_root, formats=("csv",)):
 
-# Create an instance of the ProcessedTrades class
-processed_trades = ProcessedTrades()
+    start = time.perf_counter()
 
-# Process transfers data
-processed_trades.process_file(
-    "Transfers", processed_trades.process_transfers, "Transfers"
-)
+    # Report the failure instead of raising it, so one bad account does not stop the batch
+    try:
+        run_pipeline(input_dir, output_root, formats=formats)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
 
-# Process deposit auto swaps
-processed_trades.process_file(
-    "Transfers", processed_trades.process_deposit_swaps, "Deposit_Swaps"
-)
+    return {
+        "Account": account,
+        "Status": "OK" if error is None else "FAILED",
+        "Seconds": round(time.perf_counter() - start, 3),
+        "Error": error,
+    }
 
-# Process funding data
-processed_trades.process_file(
-    "Funding", processed_trades.process_funding, "Funding"
-)
 
-# Process trade data
-processed_trades.process_file(
-    "Trades", processed_trades.process_trades, "Trades"
-)
+# Function to check whether a folder holds trades exports, such as Trades.csv or Trades_2023.csv
+def has_trades(path):
+    return bool(glob.glob(os.path.join(glob.escape(path), "Trades*.csv")))
+
+
+# Function to find account input folders, either given directly or as sub-folders of a directory
+def find_accounts(paths):
+
+    accounts = {}
+
+    for path in paths:
 
-# Process granular blocks of trades data
-processed_trades.process_granular_data()
+        # A folder holding the exports is an account on its own
+        if has_trades(path):
+            folders = [path]
 
-# Process buy-side loans
-processed_trades.process_buy_side_loans()
+        # Otherwise every sub-folder holding the exports is an account
+        else:
+            folders = [
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if has_trades(os.path.join(path, name))
+            ]
+
+        for folder in folders:
+
+            # Name each account after its folder, every account needs its own output tree
+            account = os.path.basename(os.path.normpath(folder))
+            if account in accounts:
+                raise ValueError(f"Duplicate account folder name: {account}")
+            accounts[account] = folder
 
-# Process sell-side loans
-processed_trades.process_sell_side_loans()
+    return accounts
 
-# Merge and save loan data frames
-processed_trades.merge_loans()
 
+# Function to run the full pipeline for many accounts in a pool of worker processes
+def run_batch(paths, output_root="Accounts", max_workers=None, formats=("csv",)):
+
+    # Find the account input folders
+    accounts = find_accounts(paths)
+
+    # Run each account in a worker process, writing into its own output tree
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=process_context()
+    ) as executor:
+        futures = [
+            executor.submit(
+                run_account,
+                account,
+                folder,
+                os.path.join(output_root, account),
+                formats,
+            )
+            for account, folder in accounts.items()
+        ]
+        results = [future.result() for future in futures]
 
-# Accessing trade data
-trade_data = processed_trades.access_data("trade", "BTC-USDC")
+    # Save and print the timing and status of every account
+    summary = pd.DataFrame(results, columns=["Account", "Status", "Seconds", "Error"])
+    os.makedirs(output_root, exist_ok=True)
+    summary.to_csv(os.path.join(output_root, "Batch_Summary.csv"), index=False)
 
-# Accessing buy-side data
-buy_side_data = processed_trades.access_data("buy_side", "FYI-USDC")
+    print(summary[["Account", "Status", "Seconds"]].to_string(index=False))
+    for result in results:
+        if result["Error"] is not None:
+            print(f"\n{result['Account']} failed:\n{result['Error']}")
 
-# Accessing sell-side data
-sell_side_data = processed_trades.access_data("sell_side", "ETH-USDC")
+    return summary
 
 
-# Call the method to save the trade data into the "Trade_Data" folder
-processed_trades.save_data(processed_trades.trade_data, "Trade_Data")
+if __name__ == "__main__":
 
-# Call the method to save the buy-side data into the "Buy_Side_Data" folder
-processed_trades.save_data(processed_trades.buy_side_data, "Buy_Side_Data")
+    # Process the given account folders as a batch, or the default single account
+    from dydx_cli import main
 
-# Call the method to save the sell-side data into the "Sell_Side_Data" folder
-processed_trades.save_data(processed_trades.sell_side_data, "Sell_Side_Data")
+    main(["batch", *sys.argv[1:]] if len(sys.argv) > 1 else ["run"])
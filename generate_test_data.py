@@ -0,0 +1,287 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from dydx_data_processing import ProcessedTrades, SCHEMAS, USDC_DECIMALS
+
+
+# Markets used first, more are named after their number
+MARKETS = [
+    "BTC-USD", "ETH-USD", "SOL-USD", "LINK-USD", "AVAX-USD", "LTC-USD", "FIL-USD",
+    "MKR-USD", "YFI-USD", "AAVE-USD", "SUSHI-USD", "XLM-USD", "TRX-USD", "ALGO-USD",
+]
+
+# Columns of the export files, in the order dYdX writes them
+COLUMNS = {
+    "Trades": ["createdAt", "side", "liquidity", "type", "market", "price", "size", "fee"],
+    "Funding": ["effectiveAt", "market", "payment", "rate", "positionSize", "price"],
+    "Transfers": list(SCHEMAS["Transfers"]),
+}
+
+# Used to write scaled integers as decimal strings
+FORMATTER = ProcessedTrades()
+
+
+# Function to name the generated markets
+def market_names(markets):
+    return [
+        MARKETS[i] if i < len(MARKETS) else f"TOKEN{i}-USD" for i in range(markets)
+    ]
+
+
+# Function to draw sorted random export timestamps, in milliseconds, over the last years
+def random_times(rng, rows, years, end):
+    end_ms = pd.Timestamp(end).value // 10**6
+    start_ms = end_ms - int(years * 365.25 * 24 * 3600 * 1000)
+    return np.sort(rng.integers(start_ms, end_ms, size=rows))
+
+
+# Function to write millisecond timestamps the way the exports do, e.g. 2023-11-15T22:34:23.121Z
+def format_times(times):
+    return np.char.add(
+        np.datetime_as_string(times.astype("datetime64[ms]"), unit="ms"), "Z"
+    ).astype(object)
+
+
+# Function to write scaled integers as decimal strings, dropping the decimal point of whole numbers
+def format_numbers(values, decimals):
+    text = FORMATTER.format_scaled(pd.Series(values), decimals)
+    return text.str.removesuffix(".0").to_numpy(dtype=object)
+
+
+# Function to draw random hexadecimal hashes and addresses
+def random_hashes(rng, count, length):
+    return np.array(["0x" + rng.bytes(length).hex() for _ in range(count)], dtype=object)
+
+
+# Function to write a DataFrame of strings as a quoted CSV file, appending after the first chunk
+def write_chunk(df, file_path, first):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with open(file_path, "wb" if first else "ab") as file:
+        pa_csv.write_csv(
+            table, file, write_options=pa_csv.WriteOptions(include_header=first)
+        )
+
+
+# Function to generate the signed trade sizes of one market, in lots
+# Positions are opened by a few trades and closed by the same lots in another order,
+# so the running sum returns to zero after each position and blocks form
+def position_lots(rng, rows, max_trades=4):
+
+    # Number of opening trades of each position, enough positions to fill the rows
+    opens = rng.integers(1, max_trades + 1, size=rows // 2 + 1)
+    opens = opens[: np.searchsorted(np.cumsum(2 * opens), rows) + 1]
+    position = np.repeat(np.arange(len(opens)), opens)
+
+    # Opening lots and the same lots shuffled within each position for the closing trades
+    lots = rng.integers(1, 50, size=len(position))
+    closing = lots[np.lexsort((rng.random(len(position)), position))]
+
+    # Long or short positions
+    direction = rng.choice([-1, 1], size=len(opens))[position]
+
+    # Each position lists its opening trades, then its closing trades
+    order = np.lexsort(
+        (
+            np.tile(np.arange(len(position)), 2),
+            np.repeat([0, 1], len(position)),
+            np.tile(position, 2),
+        )
+    )
+    signed = np.concatenate([direction * lots, -direction * closing])[order]
+
+    # The last position is left open when the rows run out
+    return signed[:rows]
+
+
+# Function to generate a Trades export with positions that open and close in every market
+def generate_trades(
+    file_path, markets=10, trades=10000, years=2, end="2023-12-31", seed=0, chunksize=1000000
+):
+
+    rng = np.random.default_rng(seed)
+    names = market_names(markets)
+
+    # Spread the trades over the markets and the years
+    times = random_times(rng, trades, years, end)
+    market = rng.choice(markets, size=trades, p=rng.dirichlet(np.ones(markets)))
+
+    # Decimals of the sizes and prices of each market, from its starting price
+    start_price = np.exp(rng.uniform(np.log(0.1), np.log(50000), size=markets))
+    price_decimals = np.clip(4 - np.floor(np.log10(start_price)), 0, 6).astype(int)
+    size_decimals = np.clip(np.floor(np.log10(start_price)) - 1, 0, 4).astype(int)
+
+    lots = np.zeros(trades, dtype=np.int64)
+    prices = np.zeros(trades, dtype=np.int64)
+    fees = np.zeros(trades, dtype=np.int64)
+
+    for m in range(markets):
+        rows = np.flatnonzero(market == m)
+        if len(rows) == 0:
+            continue
+
+        # Sizes in lots and a random walk of prices, both in order of time
+        lots[rows] = position_lots(rng, len(rows))
+        walk = start_price[m] * np.exp(np.cumsum(rng.normal(0, 0.01, size=len(rows))))
+        prices[rows] = np.maximum(np.round(walk * 10.0 ** price_decimals[m]), 1)
+
+        # Fees of 0.05% of the traded value, in USDC
+        fees[rows] = np.round(
+            np.abs(lots[rows])
+            * prices[rows]
+            * 5
+            * 10.0 ** (USDC_DECIMALS - 4 - size_decimals[m] - price_decimals[m])
+        )
+
+    # The export lists the newest trades first, written in chunks
+    order = np.arange(trades)[::-1]
+    for first in range(0, max(trades, 1), chunksize):
+        rows = order[first : first + chunksize]
+
+        size = np.empty(len(rows), dtype=object)
+        price = np.empty(len(rows), dtype=object)
+        for m in np.unique(market[rows]):
+            selected = market[rows] == m
+            size[selected] = format_numbers(
+                np.abs(lots[rows][selected]), size_decimals[m]
+            )
+            price[selected] = format_numbers(prices[rows][selected], price_decimals[m])
+
+        chunk = pd.DataFrame(
+            {
+                "createdAt": format_times(times[rows]),
+                "side": np.where(lots[rows] > 0, "BUY", "SELL").astype(object),
+                "liquidity": rng.choice(["TAKER", "MAKER"], size=len(rows)).astype(object),
+                "type": rng.choice(["MARKET", "LIMIT"], size=len(rows)).astype(object),
+                "market": np.array(names, dtype=object)[market[rows]],
+                "price": price,
+                "size": size,
+                "fee": format_numbers(fees[rows], USDC_DECIMALS),
+            },
+            columns=COLUMNS["Trades"],
+        )
+        write_chunk(chunk, file_path, first == 0)
+
+
+# Function to generate a Funding export with hourly style payments in random markets
+def generate_funding(
+    file_path, markets=10, rows=10000, years=2, end="2023-12-31", seed=0, chunksize=1000000
+):
+
+    rng = np.random.default_rng(seed + 1)
+    names = np.array(market_names(markets), dtype=object)
+
+    # Payments on the hour, newest first like the export
+    times = random_times(rng, rows, years, end)[::-1]
+    times = times - times % (3600 * 1000)
+
+    for first in range(0, max(rows, 1), chunksize):
+        count = len(times[first : first + chunksize])
+        payment = np.round(rng.normal(0, 1, size=count) * 10**USDC_DECIMALS).astype(np.int64)
+        chunk = pd.DataFrame(
+            {
+                "effectiveAt": format_times(times[first : first + count]),
+                "market": names[rng.integers(0, markets, size=count)],
+                "payment": format_numbers(payment, USDC_DECIMALS),
+                "rate": format_numbers(rng.integers(-10**6, 10**6, size=count), 10),
+                "positionSize": format_numbers(rng.integers(-10**4, 10**4, size=count), 3),
+                "price": format_numbers(rng.integers(10**6, 10**11, size=count), 6),
+            },
+            columns=COLUMNS["Funding"],
+        )
+        write_chunk(chunk, file_path, first == 0)
+
+
+# Function to generate a Transfers export with deposits, withdrawals and auto deposit swaps
+def generate_transfers(file_path, rows=10, years=2, end="2023-12-31", seed=0):
+
+    rng = np.random.default_rng(seed + 2)
+
+    # Newest first like the export
+    times = random_times(rng, rows, years, end)[::-1]
+    kind = rng.choice(["DEPOSIT", "WITHDRAWAL", "FAST_WITHDRAWAL"], size=rows, p=[0.6, 0.2, 0.2])
+
+    # Some deposits are made in ETH and swapped to USDC
+    swap = (kind == "DEPOSIT") & (rng.random(rows) < 0.2)
+    credit = rng.integers(10**6, 10**10, size=rows)
+    debit = np.where(swap, rng.integers(10**5, 10**7, size=rows), credit)
+
+    deposit = kind == "DEPOSIT"
+    df = pd.DataFrame(
+        {
+            "createdAt": format_times(times),
+            "type": kind.astype(object),
+            "debitAsset": np.where(swap, "ETH", "USDC").astype(object),
+            "creditAsset": "USDC",
+            "debitAmount": np.where(
+                swap, format_numbers(debit, 6), format_numbers(debit, USDC_DECIMALS)
+            ),
+            "creditAmount": format_numbers(credit, USDC_DECIMALS),
+            "transactionHash": random_hashes(rng, rows, 32),
+            "status": "CONFIRMED",
+            "confirmedAt": format_times(times + rng.integers(1000, 600000, size=rows)),
+            "fromAddress": np.where(deposit, "", random_hashes(rng, rows, 20)),
+            "toAddress": np.where(deposit, "", random_hashes(rng, rows, 20)),
+        },
+        columns=COLUMNS["Transfers"],
+    )
+    write_chunk(df, file_path, True)
+
+
+# Function to generate a complete set of exports in a folder
+def generate_exports(
+    output_dir="Original_Files",
+    markets=10,
+    trades=10000,
+    years=2,
+    funding=None,
+    transfers=None,
+    end="2023-12-31",
+    seed=0,
+):
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Default to as many funding payments as trades and a transfer per thousand trades
+    funding = trades if funding is None else funding
+    transfers = max(10, trades // 1000) if transfers is None else transfers
+
+    generate_trades(
+        os.path.join(output_dir, "Trades.csv"), markets, trades, years, end, seed
+    )
+    generate_funding(
+        os.path.join(output_dir, "Funding.csv"), markets, funding, years, end, seed
+    )
+    generate_transfers(
+        os.path.join(output_dir, "Transfers.csv"), transfers, years, end, seed
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic dYdX Trades, Funding and Transfers exports"
+    )
+    parser.add_argument("output_dir", help="folder to write the exports to")
+    parser.add_argument("--markets", type=int, default=10)
+    parser.add_argument("--trades", type=int, default=10000)
+    parser.add_argument("--years", type=float, default=2)
+    parser.add_argument("--funding", type=int, default=None)
+    parser.add_argument("--transfers", type=int, default=None)
+    parser.add_argument("--end", default="2023-12-31")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_exports(
+        args.output_dir,
+        args.markets,
+        args.trades,
+        args.years,
+        args.funding,
+        args.transfers,
+        args.end,
+        args.seed,
+    )
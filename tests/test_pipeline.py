@@ -0,0 +1,380 @@
+import json
+import os
+import shutil
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+
+from csv_date_filter import INDEX_SUFFIX, filter_csv_files, filter_csv_windows
+from dydx_cli import main
+from dydx_data_processing import ProcessedTrades, find_accounts, run_pipeline
+
+
+# Sample exports, and the outputs of the pandas backend on them that every run must match
+# The golden files are written again with run_pipeline(output_root="tests/golden")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INPUT_DIR = os.path.join(ROOT, "Original_Files")
+GOLDEN_DIR = os.path.join(ROOT, "tests", "golden")
+
+
+# Function to list the files of an output tree, relative to its root
+def output_files(root):
+    return sorted(
+        os.path.relpath(os.path.join(directory, file_name), root)
+        for directory, _, file_names in os.walk(root)
+        for file_name in file_names
+    )
+
+
+# Function to check that an output tree holds the golden files, byte for byte
+# The indexes are compared without the modification time of the file they were written for,
+# the files left out are checked by the caller
+def assert_golden_outputs(output_root, left_out=()):
+    assert output_files(output_root) == output_files(GOLDEN_DIR)
+    for name in output_files(GOLDEN_DIR):
+        if name in left_out:
+            continue
+        if name.endswith(INDEX_SUFFIX):
+            with open(os.path.join(output_root, name)) as output:
+                index = json.load(output)
+            index.pop("mtime_ns")
+            with open(os.path.join(GOLDEN_DIR, name)) as golden:
+                assert index == json.load(golden), name
+            continue
+        with open(os.path.join(GOLDEN_DIR, name), "rb") as golden:
+            with open(os.path.join(output_root, name), "rb") as output:
+                assert output.read() == golden.read(), name
+
+
+# Function to check that the trade data, loan files and merged loans of a run are the golden files
+# Runs that only write these leave the other outputs and the indexes out, or the merged loans too
+def assert_golden_trade_outputs(output_root, merged=True):
+    names = [
+        name
+        for name in output_files(GOLDEN_DIR)
+        if name.endswith(".csv")
+        and (
+            not name.startswith("Output")
+            or merged
+            and os.path.basename(name)
+            in ["dYdX_Trades.csv", "dYdX_USDC_Loans.csv", "dYdX_Crypto_Loans.csv"]
+        )
+    ]
+    assert [name for name in output_files(output_root) if name.endswith(".csv")] == names
+    for name in names:
+        with open(os.path.join(GOLDEN_DIR, name), "rb") as golden:
+            with open(os.path.join(output_root, name), "rb") as output:
+                assert output.read() == golden.read(), name
+
+
+# Function to copy the sample exports into a folder, leaving out the newest trades
+def copy_exports(input_dir, newest_trades_left_out=0):
+    input_dir.mkdir(parents=True)
+    for name in ["Funding.csv", "Transfers.csv"]:
+        (input_dir / name).write_bytes(open(os.path.join(INPUT_DIR, name), "rb").read())
+    header, *rows = open(os.path.join(INPUT_DIR, "Trades.csv")).read().split("\n")
+    (input_dir / "Trades.csv").write_text("\n".join([header, *rows[newest_trades_left_out:]]))
+    return input_dir
+
+
+@pytest.mark.parametrize("backend", ["pandas", "arrow"])
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"compact": True}, {"workers": 3}, {"csv_writer": "arrow"}],
+    ids=["default", "compact", "workers", "arrow-writer"],
+)
+def test_pipeline_matches_golden_outputs(tmp_path, backend, options):
+    run_pipeline(
+        input_dir=INPUT_DIR, output_root=str(tmp_path), backend=backend, **options
+    )
+    assert_golden_outputs(tmp_path)
+
+
+def test_chunked_funding_matches_golden_outputs(tmp_path):
+    run_pipeline(
+        input_dir=INPUT_DIR,
+        output_root=str(tmp_path),
+        formats=("csv", "parquet"),
+        targets=["Funding"],
+        funding_chunksize=1000,
+        funding_by_market=True,
+    )
+
+    with open(os.path.join(GOLDEN_DIR, "Output", "dYdX_Funding.csv"), "rb") as golden:
+        with open(tmp_path / "Output" / "dYdX_Funding.csv", "rb") as output:
+            assert output.read() == golden.read()
+
+    # The market totals of each day add up to the day's funding
+    funding = pd.read_csv(
+        tmp_path / "Output" / "dYdX_Funding.csv", dtype=str, index_col="Koinly Date"
+    )
+    by_market = pd.read_csv(tmp_path / "Output" / "dYdX_Funding_By_Market.csv", dtype=str)
+    assert (
+        by_market["Amount"].map(Decimal).groupby(by_market["Koinly Date"]).sum()
+        == funding["Amount"].map(Decimal)
+    ).all()
+    assert os.path.isdir(tmp_path / "Store" / "dYdX_Funding_By_Market")
+
+
+# Exports without their optional columns give the same outputs, with the funding read whole
+# or in chunks, and the transfers keep the columns they left out, empty
+@pytest.mark.parametrize("funding_chunksize", [None, 1000])
+def test_exports_without_optional_columns_match_golden_outputs(tmp_path, funding_chunksize):
+    input_dir = copy_exports(tmp_path / "Exports")
+    transfer_columns = ["status", "confirmedAt", "fromAddress", "toAddress"]
+    for name, columns in [("Funding", ["market"]), ("Transfers", transfer_columns)]:
+        df = pd.read_csv(input_dir / f"{name}.csv", dtype=str, keep_default_na=False)
+        df.drop(columns=columns).to_csv(input_dir / f"{name}.csv", index=False)
+
+    output_root = tmp_path / "Output_Root"
+    run_pipeline(
+        input_dir=str(input_dir),
+        output_root=str(output_root),
+        funding_chunksize=funding_chunksize,
+    )
+    transfers = os.path.join("Output", "dYdX_Transfers.csv")
+    assert_golden_outputs(output_root, left_out=[transfers])
+
+    expected = pd.read_csv(os.path.join(GOLDEN_DIR, transfers), dtype=str, keep_default_na=False)
+    expected[transfer_columns] = ""
+    pd.testing.assert_frame_equal(
+        pd.read_csv(output_root / transfers, dtype=str, keep_default_na=False), expected
+    )
+
+
+@pytest.mark.parametrize("backend", ["pandas", "arrow"])
+def test_pairs_keep_their_own_decimals(tmp_path, backend):
+    # Large bitcoin trades next to a market priced with many decimals, whose scales combined
+    # would not fit the bitcoin totals in 64-bit integers
+    input_dir = tmp_path / "Original_Files"
+    input_dir.mkdir()
+    for name in ["Funding.csv", "Transfers.csv"]:
+        (input_dir / name).write_bytes(open(os.path.join(INPUT_DIR, name), "rb").read())
+    header, *rows = open(os.path.join(INPUT_DIR, "Trades.csv")).read().split("\n")
+    new_rows = [
+        '"2023-11-16T12:00:00.000Z","SELL","TAKER","MARKET","PEPE-USD","0.0000013","1000000","0.01"',
+        '"2023-11-16T11:00:00.000Z","BUY","TAKER","MARKET","PEPE-USD","0.0000012345","1000000","0.01"',
+        '"2023-11-16T10:00:00.000Z","BUY","TAKER","MARKET","BTC-USD","60000.5","25","1.5"',
+    ]
+    (input_dir / "Trades.csv").write_text("\n".join([header, *new_rows, *rows]))
+
+    run_pipeline(input_dir=str(input_dir), output_root=str(tmp_path), backend=backend)
+
+    trades = pd.read_csv(tmp_path / "Output" / "dYdX_Trades.csv", dtype=str)
+    assert trades.iloc[:3][["Price", "Total"]].values.tolist() == [
+        ["0.0000013", "-1.3"],
+        ["0.0000012345", "1.2345"],
+        ["60000.5", "1500012.5"],
+    ]
+
+
+def test_single_export_with_a_suffix_matches_golden_outputs(tmp_path):
+    # An account folder whose only trades export is named after its year
+    input_dir = tmp_path / "Accounts" / "main"
+    input_dir.mkdir(parents=True)
+    for name, new_name in [
+        ("Trades.csv", "Trades_2023.csv"),
+        ("Funding.csv", "Funding.csv"),
+        ("Transfers.csv", "Transfers.csv"),
+    ]:
+        (input_dir / new_name).write_bytes(open(os.path.join(INPUT_DIR, name), "rb").read())
+
+    assert find_accounts([str(tmp_path / "Accounts")]) == {"main": str(input_dir)}
+
+    output_root = tmp_path / "Output_Root"
+    run_pipeline(input_dir=str(input_dir), output_root=str(output_root))
+    assert_golden_outputs(output_root)
+
+
+def test_cache_is_brought_under_its_size_after_a_run(tmp_path):
+    cache_dir = tmp_path / "Cache"
+    run_pipeline(input_dir=INPUT_DIR, output_root=str(tmp_path / "First"), cache_dir=str(cache_dir))
+    assert os.listdir(cache_dir)
+
+    # An unchanged rerun uses every entry, which are removed once it ends as none fit
+    output_root = tmp_path / "Second"
+    run_pipeline(
+        input_dir=INPUT_DIR, output_root=str(output_root), cache_dir=str(cache_dir), cache_size=1
+    )
+    assert_golden_outputs(output_root)
+    assert os.listdir(cache_dir) == []
+
+
+# The newest trades of the first run close blocks whose loans interleave with earlier ones
+@pytest.mark.parametrize("newest_trades_left_out", [300, 610, 611, 612])
+def test_incremental_run_matches_full_run(tmp_path, newest_trades_left_out):
+    earlier_dir = copy_exports(tmp_path / "Earlier", newest_trades_left_out)
+    output_root = tmp_path / "Output_Root"
+    for input_dir in [str(earlier_dir), INPUT_DIR]:
+        main(["incremental", "--input-dir", input_dir, "--output-root", str(output_root)])
+    assert_golden_trade_outputs(output_root)
+
+
+# Blocks close at the chunk boundaries of the small chunk sizes
+@pytest.mark.parametrize("chunksize", [3, 5, 7, 13, 100000])
+def test_stream_run_matches_full_run(tmp_path, chunksize):
+    main(
+        [
+            "stream",
+            "--input-dir",
+            INPUT_DIR,
+            "--output-root",
+            str(tmp_path),
+            "--chunksize",
+            str(chunksize),
+        ]
+    )
+    assert_golden_trade_outputs(tmp_path)
+
+
+# Every pair processed on its own when it is asked for is the same as in a full run
+def test_lazy_pairs_match_full_run(tmp_path):
+    processed_trades = ProcessedTrades(input_dir=INPUT_DIR, lazy=True)
+    for data_type, directory in [
+        ("trade", "Trade_Data"),
+        ("buy_side", "Buy_Side_Data"),
+        ("sell_side", "Sell_Side_Data"),
+    ]:
+        processed_trades.save_csv_data(
+            processed_trades.access_data(data_type), str(tmp_path / directory)
+        )
+    assert_golden_trade_outputs(tmp_path, merged=False)
+
+
+def test_stream_run_merges_overlapping_exports(tmp_path):
+    # The newest trades and an older export sharing some of them
+    input_dir = copy_exports(tmp_path / "Original_Files")
+    header, *rows = (input_dir / "Trades.csv").read_text().split("\n")
+    (input_dir / "Trades.csv").write_text("\n".join([header, *rows[:350]]))
+    (input_dir / "Trades_2022.csv").write_text("\n".join([header, *rows[300:]]))
+
+    output_root = tmp_path / "Output_Root"
+    main(
+        [
+            "stream",
+            "--input-dir",
+            str(input_dir),
+            "--output-root",
+            str(output_root),
+            "--chunksize",
+            "100",
+        ]
+    )
+    assert_golden_trade_outputs(output_root)
+
+
+def test_merge_loans_returns_the_merged_loans(tmp_path):
+    processed_trades = ProcessedTrades(input_dir=INPUT_DIR, output_dir=str(tmp_path))
+    processed_trades.process_file("Trades", processed_trades.process_trades, "Trades")
+    processed_trades.process_granular_data()
+    processed_trades.process_buy_side_loans()
+    processed_trades.process_sell_side_loans()
+    merged_buy_df, merged_sell_df = processed_trades.merge_loans()
+
+    for merged_df, name in [(merged_buy_df, "USDC_Loans"), (merged_sell_df, "Crypto_Loans")]:
+        with open(os.path.join(GOLDEN_DIR, "Output", f"dYdX_{name}.csv"), "rb") as golden:
+            assert merged_df.to_csv().encode() == golden.read()
+
+
+def test_merge_loans_rejects_loans_out_of_date_order(tmp_path):
+    # The loans of a pair with its first two loans swapped
+    with open(os.path.join(GOLDEN_DIR, "Buy_Side_Data", "ETH-USDC.csv")) as f:
+        header, first, second, *rows = f.read().splitlines()
+    file_name = tmp_path / "ETH-USDC.csv"
+    file_name.write_text("\n".join([header, second, first, *rows]) + "\n")
+
+    processed_trades = ProcessedTrades(output_dir=str(tmp_path / "Output"))
+    processed_trades.buy_side_files["ETH-USDC"] = str(file_name)
+    with pytest.raises(ValueError, match="not in date order"):
+        processed_trades.merge_loans(return_frames=False)
+
+
+# The funding stage peaks above the stages run after it
+def test_profile_total_peak_covers_every_stage(tmp_path):
+    run_pipeline(input_dir=INPUT_DIR, output_root=str(tmp_path), profile=True)
+    with open(tmp_path / "Profile.json") as f:
+        report = json.load(f)
+    assert report["peak_memory_mb"] >= max(
+        stage["peak_memory_mb"] for stage in report["stages"]
+    )
+
+
+# A file written again at the same size gets its index rebuilt before it is filtered
+def test_filter_rebuilds_the_index_of_a_changed_file(tmp_path, monkeypatch):
+    folder = tmp_path / "Buy_Side_Data"
+    folder.mkdir()
+    for name in ["ETH-USDC.csv", f"ETH-USDC.csv{INDEX_SUFFIX}"]:
+        (folder / name).write_bytes(
+            open(os.path.join(GOLDEN_DIR, "Buy_Side_Data", name), "rb").read()
+        )
+
+    # Move the last repayment a year later, past the last date the index has
+    file_name = folder / "ETH-USDC.csv"
+    text = file_name.read_text()
+    file_name.write_text(text.replace("2023-11-03 00:57:00", "2024-11-03 00:57:00"))
+    os.utime(file_name, ns=(0, 0))
+    assert file_name.stat().st_size == len(text)
+
+    monkeypatch.chdir(tmp_path)
+    filter_csv_files(str(folder), pd.Timestamp("2024-11-03"), pd.Timestamp("2024-11-03"))
+    filtered = open(tmp_path / "Buy_Side_Data_2024-11-03_2024-11-03" / "ETH-USDC.csv").read()
+    assert "2024-11-03 00:57:00,,,5466.6,USDC,Margin Repayment" in filtered
+    with open(folder / f"ETH-USDC.csv{INDEX_SUFFIX}") as f:
+        assert json.load(f)["mtime_ns"] == 0
+
+
+# Overlapping windows filtered from one read of each file are the windows filtered one at a time
+def test_filter_windows_match_single_windows(tmp_path, monkeypatch):
+    shutil.copytree(GOLDEN_DIR, tmp_path / "Golden")
+    windows = [
+        (pd.Timestamp("2023-01-01"), pd.Timestamp("2023-03-31")),
+        (pd.Timestamp("2023-03-01"), pd.Timestamp("2023-08-31")),
+    ]
+    folders = [str(tmp_path / "Golden" / name) for name in ["Trade_Data", "Buy_Side_Data"]]
+
+    (tmp_path / "Together").mkdir()
+    monkeypatch.chdir(tmp_path / "Together")
+    for folder in folders:
+        filter_csv_windows(folder, windows)
+
+    (tmp_path / "Apart").mkdir()
+    monkeypatch.chdir(tmp_path / "Apart")
+    for folder in folders:
+        for start_date, end_date in windows:
+            filter_csv_files(folder, start_date, end_date)
+
+    names = output_files(tmp_path / "Apart")
+    assert len(names) > len(folders) * len(windows)
+    assert output_files(tmp_path / "Together") == names
+    for name in names:
+        with open(tmp_path / "Apart" / name, "rb") as apart:
+            with open(tmp_path / "Together" / name, "rb") as together:
+                assert together.read() == apart.read(), name
+
+
+# The outputs of a run verify, and each changed file is reported
+def test_verify_reports_changed_outputs(tmp_path):
+    shutil.copytree(GOLDEN_DIR, tmp_path / "Golden")
+    processed_trades = ProcessedTrades(
+        input_dir=INPUT_DIR, output_dir=str(tmp_path / "Golden" / "Output")
+    )
+    trade_dir = str(tmp_path / "Golden" / "Trade_Data")
+    assert processed_trades.verify_outputs(trade_dir).empty
+
+    # Remove the first repayment of the USDC loans
+    loans_file = tmp_path / "Golden" / "Output" / "dYdX_USDC_Loans.csv"
+    lines = loans_file.read_text().splitlines(keepends=True)
+    repayment = next(i for i, line in enumerate(lines) if line.endswith("Margin Repayment\n"))
+    loans_file.write_text("".join(lines[:repayment] + lines[repayment + 1 :]))
+    report = processed_trades.verify_outputs(trade_dir)
+    assert report["Check"].tolist() == ["Loans"]
+    assert report["File"].tolist() == ["dYdX_USDC_Loans.csv"]
+
+    # Change the amount of a trade in the first block of a pair
+    trade_file = tmp_path / "Golden" / "Trade_Data" / "ETH-USDC.csv"
+    header, first, *rows = trade_file.read_text().splitlines(keepends=True)
+    trade_file.write_text("".join([header, first.replace(",-0.9,", ",-0.8,", 1), *rows]))
+    report = processed_trades.verify_outputs(trade_dir)
+    assert report["Check"].tolist() == ["Loans", "Blocks"]
+    assert report["Block"].tolist()[1:] == [0]